@@ -1,4 +1,5 @@
 from sorl.thumbnail.fields import ImageField
-from sorl.thumbnail.shortcuts import get_thumbnail, delete
+from sorl.thumbnail.shortcuts import get_thumbnail, get_thumbnails, delete
+from sorl.thumbnail.shortcuts import get_cached_thumbnails
 from sorl import __version__, VERSION
 
@@ -1,7 +1,11 @@
+from __future__ import with_statement
+import time
+from django.utils.datastructures import SortedDict
 from sorl.thumbnail.conf import settings, defaults as default_settings
 from sorl.thumbnail.helpers import tokey, serialize
-from sorl.thumbnail.images import ImageFile
-from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile, LazyImageFile
+from sorl.thumbnail import default, processes
+from sorl.thumbnail.metrics import measure
 from sorl.thumbnail.parsers import parse_geometry
 
 
@@ -10,6 +14,12 @@ EXTENSIONS = {
     'PNG': 'png',
 }
 
+# Formats that can be used as input for derived thumbnails of any format
+LOSSLESS_FORMATS = ('PNG',)
+
+# Lazy thumbnail names remembered as stored requests in each process
+LAZY_NAMES_MAX = 10000
+
 
 class ThumbnailBackend(object):
     """
@@ -29,42 +39,122 @@ class ThumbnailBackend(object):
         ('orientation', 'THUMBNAIL_ORIENTATION'),
     )
 
+    # Seconds between key value store lookups while waiting for a thumbnail
+    # that is being created by another process
+    lock_poll_interval = 0.1
+
+    def __init__(self):
+        # Names of the lazy thumbnails whose requests this process stored
+        self._lazy_names = set()
+
     def get_thumbnail(self, file_, geometry_string, **options):
         """
         Returns thumbnail as an ImageFile instance for file with geometry and
         options given. First it will try to get it from the key value store,
         secondly it will create it.
         """
+        return self.get_thumbnails(file_, [geometry_string], **options)[0]
+
+    def get_thumbnails(self, file_, geometry_strings, **options):
+        """
+        Returns a list of thumbnails as ImageFile instances for file with the
+        geometries and options given, in the same order as
+        ``geometry_strings``. The thumbnails are looked up in the key value
+        store together and the source is only read and decoded once for all
+        thumbnails that need to be created.
+        """
         source = ImageFile(file_)
-        for key, value in self.default_options.iteritems():
-            options.setdefault(key, value)
-        # For the future I think it is better to add options only if they
-        # differ from the default settings as below. This will ensure the same
-        # filenames beeing generated for new options at default.
-        for key, attr in self.extra_options:
-            value = getattr(settings, attr)
-            if value != getattr(default_settings, attr):
-                options.setdefault(key, value)
-        name = self._get_thumbnail_filename(source, geometry_string, options)
-        thumbnail = ImageFile(name, default.storage)
-        cached = default.kvstore.get(thumbnail)
-        if cached:
-            return cached
-        if not thumbnail.exists():
-            # We have to check exists() because the Storage backend does not
-            # overwrite in some implementations.
-            source_image = default.engine.get_image(source)
-            # We might as well set the size since we have the image in memory
-            size = default.engine.get_image_size(source_image)
-            source.set_size(size)
-            self._create_thumbnail(source_image, geometry_string, options,
-                                   thumbnail)
-        # If the thumbnail exists we don't create it, the other option is
-        # to delete and write but this could lead to race conditions so I
-        # will just leave that out for now.
-        default.kvstore.get_or_set(source)
-        default.kvstore.set(thumbnail, source)
-        return thumbnail
+        self._set_default_options(options)
+        if settings.THUMBNAIL_LAZY:
+            return [self._get_lazy_thumbnail(source, geometry_string, options)
+                    for geometry_string in geometry_strings]
+        return self._get_thumbnails(source, geometry_strings, options)
+
+    def get_cached_thumbnails(self, requests):
+        """
+        Looks up the thumbnails for a list of ``(file_, geometry_string,
+        options)`` tuples in the key value store with one lookup. Returns a
+        list in the same order as ``requests`` with ``None`` for thumbnails
+        that are not in store or have an empty ``file_``, nothing is created.
+        """
+        thumbnails = []
+        for file_, geometry_string, options in requests:
+            if not file_:
+                continue
+            options = dict(options)
+            self._set_default_options(options)
+            name = self._get_thumbnail_filename(ImageFile(file_),
+                                                geometry_string, options)
+            thumbnails.append(ImageFile(name, default.storage))
+        with measure('kvstore_get', count=len(thumbnails)):
+            cached = iter(default.kvstore.get_many(thumbnails))
+        results = []
+        for file_, geometry_string, options in requests:
+            if file_:
+                results.append(cached.next())
+            else:
+                results.append(None)
+        return results
+
+    def _get_thumbnails(self, source, geometry_strings, options):
+        """
+        Looks up the thumbnails in the key value store and creates the
+        missing ones, see :meth:`get_thumbnails`.
+        """
+        thumbnails = []
+        for geometry_string in geometry_strings:
+            name = self._get_thumbnail_filename(source, geometry_string,
+                                                options)
+            thumbnails.append(ImageFile(name, default.storage))
+        unique = SortedDict()
+        for geometry_string, thumbnail in zip(geometry_strings, thumbnails):
+            unique.setdefault(thumbnail.name, geometry_string)
+        if len(unique) < len(thumbnails):
+            # Repeated geometries would create the same thumbnail twice
+            found = dict(zip(unique.keys(), self._get_thumbnails(
+                source, unique.values(), options)))
+            return [found[thumbnail.name] for thumbnail in thumbnails]
+        with measure('kvstore_get', count=len(thumbnails)):
+            cached = default.kvstore.get_many(thumbnails)
+        missing = []
+        for i, geometry_string in enumerate(geometry_strings):
+            if cached[i]:
+                thumbnails[i] = cached[i]
+            else:
+                missing.append((geometry_string, thumbnails[i]))
+        if not missing:
+            return thumbnails
+        if not settings.THUMBNAIL_LOCK:
+            self._create_missing(source, missing, options)
+            return thumbnails
+        # Only one process at a time creates a thumbnail, the others wait for
+        # it to show up in the key value store.
+        locked = []
+        tokens = []
+        waiting = []
+        for geometry_string, thumbnail in missing:
+            token = default.kvstore.lock(thumbnail,
+                                         settings.THUMBNAIL_LOCK_TIMEOUT)
+            if token:
+                locked.append((geometry_string, thumbnail))
+                tokens.append(token)
+            else:
+                waiting.append((geometry_string, thumbnail))
+        try:
+            self._create_missing(source, locked, options)
+        finally:
+            for (geometry_string, thumbnail), token in zip(locked, tokens):
+                default.kvstore.unlock(thumbnail, token)
+        timed_out = []
+        cached = self._wait_for_thumbnails([t for g, t in waiting])
+        for (geometry_string, thumbnail), cached_thumbnail in zip(waiting,
+                                                                  cached):
+            if cached_thumbnail:
+                thumbnails[thumbnails.index(thumbnail)] = cached_thumbnail
+            else:
+                timed_out.append((geometry_string, thumbnail))
+        self._create_missing(source, timed_out, options)
+        return thumbnails
 
     def delete(self, file_, delete_file=True):
         """
@@ -76,18 +166,243 @@ class ThumbnailBackend(object):
             image_file.delete()
         default.kvstore.delete(image_file)
 
-    def _create_thumbnail(self, source_image, geometry_string, options,
-                          thumbnail):
+    def get_lazy_thumbnail(self, name):
+        """
+        Returns the lazy thumbnail ``name`` as an ImageFile instance, creating
+        it if needed from the request stored when it was returned by
+        :meth:`get_thumbnails`. Returns ``None`` if no request is stored for
+        ``name``.
+        """
+        request = default.kvstore.get_request(ImageFile(name, default.storage))
+        if request is None:
+            return None
+        source, geometry_string, options = request
+        if self._get_thumbnail_filename(source, geometry_string,
+                                        options) != name:
+            return None
+        return self._get_thumbnails(source, [geometry_string], options)[0]
+
+    def _get_lazy_thumbnail(self, source, geometry_string, options):
+        """
+        Returns a thumbnail whose url is computed from the filename alone. It
+        is looked up in the key value store and created if needed when its
+        size is accessed, or by :meth:`get_lazy_thumbnail` when its url is
+        requested. The request for it is stored once for each process.
+        """
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        def resolve():
+            return self._get_thumbnails(source, [geometry_string], options)[0]
+        thumbnail = LazyImageFile(name, default.storage, resolve)
+        if name not in self._lazy_names:
+            default.kvstore.set_request(thumbnail, source, geometry_string,
+                                        options)
+            if len(self._lazy_names) >= LAZY_NAMES_MAX:
+                self._lazy_names.clear()
+            self._lazy_names.add(name)
+        return thumbnail
+
+    def _create_missing(self, source, missing, options):
         """
-        Creates the thumbnail by using default.engine
+        Creates the thumbnails for all ``(geometry_string, thumbnail)`` pairs
+        in ``missing`` that do not exist and adds them to the key value store.
+        """
+        if not missing:
+            return
+        to_create = []
+        for geometry_string, thumbnail in missing:
+            with measure('exists'):
+                exists = thumbnail.exists()
+            if not exists:
+                # We have to check exists() because the Storage backend does
+                # not overwrite in some implementations.
+                to_create.append((geometry_string, thumbnail))
+        if to_create:
+            if settings.THUMBNAIL_DERIVE:
+                jobs = self._get_derivation_jobs(source, to_create, options)
+            else:
+                jobs = [(source, to_create)]
+            for input_file, job in jobs:
+                self._create_thumbnails(input_file, job, options)
+        # If the thumbnail exists we don't create it, the other option is
+        # to delete and write but this could lead to race conditions so I
+        # will just leave that out for now.
+        thumbnail_options = None
+        if settings.THUMBNAIL_DERIVE:
+            thumbnail_options = options
+        with measure('kvstore_set', count=len(missing)):
+            default.kvstore.get_or_set(source)
+            default.kvstore.set_many([thumbnail for g, thumbnail in missing],
+                                     source, thumbnail_options)
+
+    def _wait_for_thumbnails(self, thumbnails):
+        """
+        Waits for thumbnails locked by other processes to show up in the key
+        value store. Returns a list in the same order as ``thumbnails`` with
+        ``None`` for those that did not show up within ``THUMBNAIL_LOCK_WAIT``
+        seconds in total.
+        """
+        results = [None] * len(thumbnails)
+        pending = range(len(thumbnails))
+        deadline = time.time() + settings.THUMBNAIL_LOCK_WAIT
+        while pending and time.time() < deadline:
+            time.sleep(self.lock_poll_interval)
+            cached = default.kvstore.get_many([thumbnails[i] for i in pending])
+            still_pending = []
+            for i, cached_thumbnail in zip(pending, cached):
+                if cached_thumbnail:
+                    results[i] = cached_thumbnail
+                else:
+                    still_pending.append(i)
+            pending = still_pending
+        return results
+
+    def _create_thumbnails(self, source, to_create, options):
+        """
+        Creates thumbnails for all ``(geometry_string, thumbnail)`` pairs in
+        ``to_create`` reading and decoding ``source`` only once, in a worker
+        process if ``THUMBNAIL_PROCESSES`` is set.
+        """
+        if processes.enabled():
+            processes.create_thumbnails(source, to_create, options)
+        else:
+            self._render_thumbnails(source, to_create, options)
+
+    def _render_thumbnails(self, source, to_create, options):
+        """
+        Creates thumbnails for all ``(geometry_string, thumbnail)`` pairs in
+        ``to_create`` in this process.
+        """
+        with measure('get_image'):
+            source_image = default.engine.get_image(source)
+        try:
+            # We might as well set the size since we have the image in memory
+            size = default.engine.get_image_size(source_image)
+            source.set_size(size)
+            last = len(to_create) - 1
+            draft = not last
+            if not draft:
+                # Engines may load the source at a reduced size in place, so
+                # it is drafted once for the largest size any thumbnail needs.
+                ratio = default.engine.get_image_ratio(source_image)
+                geometries = [parse_geometry(geometry_string, ratio)
+                              for geometry_string, t in to_create]
+                source_image = default.engine.run_stage(
+                    default.engine.draft_many, source_image, geometries,
+                    options)
+            images = []
+            for i, (geometry_string, thumbnail) in enumerate(to_create):
+                if i < last:
+                    # Engines may process the image in place so all but the
+                    # last thumbnail are created from a copy.
+                    image = default.engine.copy_image(source_image)
+                else:
+                    image = source_image
+                image = self._create_thumbnail_image(image, geometry_string,
+                                                     options, draft)
+                images.append((image, thumbnail))
+            # Engines may encode all thumbnails at once
+            default.engine.write_many(images, options)
+            for image, thumbnail in images:
+                # It's much cheaper to set the size here
+                size = default.engine.get_image_size(image)
+                thumbnail.set_size(size)
+        finally:
+            default.engine.cleanup(source_image)
+
+    def _get_derivation_jobs(self, source, to_create, options):
+        """
+        Groups the ``(geometry_string, thumbnail)`` pairs in ``to_create`` by
+        the image they should be created from. This is the smallest existing
+        thumbnail of ``source`` that can be used instead of ``source`` or
+        ``source`` it self. Returns a list of ``(input_file, to_create)``
+        tuples.
+        """
+        cached_source = default.kvstore.get(source)
+        if cached_source is None:
+            # A source that is not in store has no thumbnails in store
+            return [(source, to_create)]
+        derivable = self._get_derivable_thumbnails(cached_source, options)
+        jobs = SortedDict()
+        for geometry_string, thumbnail in to_create:
+            input_file = self._get_derivation_source(
+                derivable, geometry_string, options) or source
+            jobs.setdefault(input_file.key, (input_file, []))
+            jobs[input_file.key][1].append((geometry_string, thumbnail))
+        return jobs.values()
+
+    def _get_derivable_thumbnails(self, source, options):
+        """
+        Returns the thumbnails of ``source`` in the key value store that show
+        the whole source with the same colorspace and orientation as
+        ``options`` and are stored in a format good enough to be used as input
+        for thumbnails with ``options``.
+        """
+        derivable = []
+        for thumbnail, thumbnail_options in default.kvstore.get_thumbnails(
+                source):
+            if thumbnail_options is None:
+                continue
+            crop = thumbnail_options.get('crop')
+            if crop and crop != 'noop':
+                continue
+            if (thumbnail_options.get('colorspace') != options['colorspace'] or
+                thumbnail_options.get('orientation') !=
+                options.get('orientation')):
+                continue
+            format_ = thumbnail_options.get('format')
+            if format_ not in LOSSLESS_FORMATS and (
+                    format_ != options['format'] or
+                    thumbnail_options.get('quality') < options['quality']):
+                continue
+            # Upscaled thumbnails do not carry more information than the
+            # source, the orientation might have swapped width and height.
+            if (max(thumbnail.size) > max(source.size) or
+                min(thumbnail.size) > min(source.size)):
+                continue
+            derivable.append(thumbnail)
+        return derivable
+
+    def _get_derivation_source(self, derivable, geometry_string, options):
+        """
+        Returns the smallest of the ``derivable`` thumbnails that needs to be
+        scaled down by at least ``THUMBNAIL_DERIVE_FACTOR`` for
+        ``geometry_string`` or ``None`` if there is no such thumbnail.
+        """
+        candidates = []
+        for thumbnail in derivable:
+            x, y = parse_geometry(geometry_string, thumbnail.ratio)
+            factors = (float(x) / thumbnail.x, float(y) / thumbnail.y)
+            factor = max(factors) if options['crop'] else min(factors)
+            if factor * settings.THUMBNAIL_DERIVE_FACTOR <= 1:
+                candidates.append(thumbnail)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda t: t.x * t.y)
+
+    def _create_thumbnail_image(self, source_image, geometry_string,
+                                options, draft=True):
+        """
+        Creates the thumbnail image by using default.engine, it is written by
+        :meth:`_render_thumbnails`. ``draft`` is ``False`` if ``source_image``
+        is already drafted.
         """
         ratio = default.engine.get_image_ratio(source_image)
         geometry = parse_geometry(geometry_string, ratio)
-        image = default.engine.create(source_image, geometry, options)
-        default.engine.write(image, options, thumbnail)
-        # It's much cheaper to set the size here
-        size = default.engine.get_image_size(image)
-        thumbnail.set_size(size)
+        return default.engine.create(source_image, geometry, options, draft)
+
+    def _set_default_options(self, options):
+        """
+        Adds default values to ``options`` for options not given.
+        """
+        for key, value in self.default_options.iteritems():
+            options.setdefault(key, value)
+        # For the future I think it is better to add options only if they
+        # differ from the default settings as below. This will ensure the same
+        # filenames beeing generated for new options at default.
+        for key, attr in self.extra_options:
+            value = getattr(settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
 
     def _get_thumbnail_filename(self, source, geometry_string, options):
         """
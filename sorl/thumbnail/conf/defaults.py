@@ -13,6 +13,17 @@ THUMBNAIL_BACKEND = 'sorl.thumbnail.base.ThumbnailBackend'
 # Redis requires some more work, see docs
 THUMBNAIL_KVSTORE = 'sorl.thumbnail.kvstores.cached_db_kvstore.KVStore'
 
+# Number of image files kept deserialized in a process local cache in front of
+# the key value store, 0 disables the cache
+THUMBNAIL_KVSTORE_LOCAL_CACHE_SIZE = 0
+
+# Seconds an image file is kept in the local cache
+THUMBNAIL_KVSTORE_LOCAL_CACHE_TIMEOUT = 60
+
+# Seconds between checks whether another process deleted from the key value
+# store, which drops the local cache
+THUMBNAIL_KVSTORE_LOCAL_CACHE_CHECK_INTERVAL = 1
+
 # Change this to something else for MSSQL
 THUMBNAIL_KEY_DBCOLUMN = 'key'
 
@@ -20,13 +31,38 @@ THUMBNAIL_KEY_DBCOLUMN = 'key'
 # sorl.thumbnail.engines.convert_engine.Engine
 # sorl.thumbnail.engines.pil_engine.Engine
 # sorl.thumbnail.engines.pgmagick_engine.Engine
+# sorl.thumbnail.engines.numpy_engine.Engine
 # convert is preferred but requires imagemagick or graphicsmagick, se docs
 THUMBNAIL_ENGINE = 'sorl.thumbnail.engines.pil_engine.Engine'
 
+# Resampling for the PIL and NumPy engines: 'antialias', 'reduce' or 'fast'.
+# 'reduce' and 'fast' are faster but lower quality, see docs.
+THUMBNAIL_RESAMPLE_STRATEGY = 'antialias'
+
 # Path to Imagemagick or Graphicsmagick ``convert`` and ``identify``.
 THUMBNAIL_CONVERT = 'convert'
 THUMBNAIL_IDENTIFY = 'identify'
 
+# Pipe images to and from ``convert`` and ``identify`` instead of using
+# temporary files
+THUMBNAIL_CONVERT_PIPE = True
+
+# Seconds until ``convert`` and ``identify`` are killed, None waits forever
+THUMBNAIL_CONVERT_TIMEOUT = 60
+
+# Maximum number of ``convert`` and ``identify`` commands running at the same
+# time in a process, None for no limit
+THUMBNAIL_CONVERT_MAX_PROCS = None
+
+# Resource limits passed to ``convert`` and ``identify`` as ``-limit``, for
+# example {'memory': '256MiB', 'threads': 1}
+THUMBNAIL_CONVERT_LIMITS = {}
+
+# Metrics sink receiving the duration of each stage of looking up and creating
+# thumbnails, None disables measuring. Ships with:
+# sorl.thumbnail.metrics.MemoryMetrics
+THUMBNAIL_METRICS = None
+
 # Storage for the generated thumbnails
 THUMBNAIL_STORAGE = settings.DEFAULT_FILE_STORAGE
 
@@ -37,6 +73,17 @@ THUMBNAIL_REDIS_HOST = 'localhost'
 THUMBNAIL_REDIS_PORT = 6379
 THUMBNAIL_REDIS_UNIX_SOCKET_PATH = None
 
+# Maximum number of connections in the Redis connection pool shared by a
+# process, None for no limit
+THUMBNAIL_REDIS_MAX_CONNECTIONS = None
+
+# Seconds to wait for Redis to answer and to connect, None waits forever
+THUMBNAIL_REDIS_SOCKET_TIMEOUT = None
+THUMBNAIL_REDIS_SOCKET_CONNECT_TIMEOUT = None
+
+# Enable TCP keepalive for the Redis connections
+THUMBNAIL_REDIS_SOCKET_KEEPALIVE = False
+
 # Cache timeout for ``cached_db`` store. You should probably keep this at
 # maximum or ``0`` if your caching backend can handle that as infinate.
 THUMBNAIL_CACHE_TIMEOUT = 3600 * 24 * 365 * 10 # 10 years
@@ -64,9 +111,51 @@ THUMBNAIL_QUALITY = 95
 # Save as progressive when saving as jpeg
 THUMBNAIL_PROGRESSIVE = True
 
+# Thumbnails with fewer pixels are not saved as progressive unless the
+# progressive option is given, progressive encoding takes about twice as long
+# and makes small images larger
+THUMBNAIL_PROGRESSIVE_MIN_PIXELS = 250 * 250
+
+# Thumbnails with fewer pixels are saved without optimized Huffman tables
+# unless the optimize option is given
+THUMBNAIL_OPTIMIZE_MIN_PIXELS = 0
+
 # Orientate the thumbnail with respect to source EXIF orientation tag
 THUMBNAIL_ORIENTATION = True
 
+# Return thumbnails with urls computed from the filename without looking them
+# up. Thumbnails are only looked up and created when their size is accessed.
+THUMBNAIL_LAZY = False
+
+# Only let one process at a time create a thumbnail, the others wait for it
+# to show up in the key value store
+THUMBNAIL_LOCK = False
+
+# Seconds until a lock for creating a thumbnail expires
+THUMBNAIL_LOCK_TIMEOUT = 30
+
+# Seconds to wait for a thumbnail locked by another process before creating it
+THUMBNAIL_LOCK_WAIT = 10
+
+# Create thumbnails from larger existing thumbnails of the same source
+# instead of the source when possible
+THUMBNAIL_DERIVE = False
+
+# The minimum factor an existing thumbnail needs to be scaled down by to be
+# used as input when THUMBNAIL_DERIVE is True
+THUMBNAIL_DERIVE_FACTOR = 2
+
+# Number of worker processes creating thumbnails, 0 creates them in the
+# calling thread
+THUMBNAIL_PROCESSES = 0
+
+# Maximum number of thumbnail jobs handed to the worker processes at a time,
+# None means twice THUMBNAIL_PROCESSES
+THUMBNAIL_PROCESS_MAX_IN_FLIGHT = None
+
+# Seconds to wait for a worker process to create thumbnails
+THUMBNAIL_PROCESS_TIMEOUT = 60
+
 # This means sorl.thumbnail will generate and serve a generated dummy image
 # regardless of the thumbnail source content
 THUMBNAIL_DUMMY = False
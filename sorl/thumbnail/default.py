@@ -10,7 +10,12 @@ class Backend(LazyObject):
 
 class KVStore(LazyObject):
     def _setup(self):
-        self._wrapped = get_module_class(settings.THUMBNAIL_KVSTORE)()
+        kvstore = get_module_class(settings.THUMBNAIL_KVSTORE)()
+        if settings.THUMBNAIL_KVSTORE_LOCAL_CACHE_SIZE:
+            kvstore = get_module_class(
+                'sorl.thumbnail.kvstores.local_cache.LocalCacheKVStore'
+                )(kvstore)
+        self._wrapped = kvstore
 
 
 class Engine(LazyObject):
@@ -23,8 +28,14 @@ class Storage(LazyObject):
         self._wrapped = get_module_class(settings.THUMBNAIL_STORAGE)()
 
 
+class Metrics(LazyObject):
+    def _setup(self):
+        self._wrapped = get_module_class(settings.THUMBNAIL_METRICS)()
+
+
 backend = Backend()
 kvstore = KVStore()
 engine = Engine()
 storage = Storage()
+metrics = Metrics()
 
@@ -1,4 +1,8 @@
 #coding=utf-8
+from __future__ import with_statement
+import math
+from django.core.files.base import ContentFile
+from sorl.thumbnail import metrics
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.helpers import toint
 from sorl.thumbnail.parsers import parse_crop
@@ -8,16 +12,93 @@ class EngineBase(object):
     """
     ABC for Thumbnail engines, methods are static
     """
-    def create(self, image, geometry, options):
+    def create(self, image, geometry, options, draft=True):
         """
-        Processing conductor, returns the thumbnail as an image engine instance
+        Processing conductor, returns the thumbnail as an image engine
+        instance. The draft stage is skipped if ``draft`` is ``False``, for
+        images already drafted with :meth:`draft_many`.
         """
-        image = self.orientation(image, geometry, options)
-        image = self.colorspace(image, geometry, options)
-        image = self.scale(image, geometry, options)
-        image = self.crop(image, geometry, options)
+        for stage in self.get_stages(image, geometry, options):
+            if stage == self.draft and not draft:
+                continue
+            image = self.run_stage(stage, image, geometry, options)
         return image
 
+    def get_stages(self, image, geometry, options):
+        """
+        Returns the processing methods to run in order. The colorspace is
+        converted last when the engine can scale and crop the image in its
+        current colorspace, so that only the thumbnail pixels are converted.
+        """
+        if self.can_defer_colorspace(image, options['colorspace']):
+            return [self.draft, self.decode, self.orientation, self.precrop,
+                    self.scale, self.crop, self.colorspace]
+        return [self.draft, self.decode, self.orientation, self.colorspace,
+                self.precrop, self.scale, self.crop]
+
+    def run_stage(self, stage, image, geometry, options):
+        """
+        Runs the ``stage`` processing method, measuring it along with the
+        pixel counts of the images in and out when metrics are enabled.
+        """
+        if not metrics.enabled():
+            return stage(image, geometry, options)
+        x, y = self.get_image_size(image)
+        with metrics.measure(stage.__name__, pixels_in=x * y) as m:
+            image = stage(image, geometry, options)
+            x, y = self.get_image_size(image)
+            m.data['pixels_out'] = x * y
+        return image
+
+    def draft(self, image, geometry, options):
+        """
+        Wrapper for ``_draft``, asks for at least the size the image will be
+        scaled to.
+        """
+        size = self.get_draft_size(image, geometry, options)
+        if size is None:
+            return image
+        return self._draft(image, *size)
+
+    def draft_many(self, image, geometries, options):
+        """
+        Wrapper for ``_draft`` for creating thumbnails of all ``geometries``
+        from ``image``, asks for at least the size each of them will be scaled
+        from. Engines may draft the image in place so that copies of it share
+        the draft, which is why it is drafted once for all thumbnails.
+        """
+        sizes = [self.get_draft_size(image, geometry, options)
+                 for geometry in geometries]
+        if not sizes or None in sizes:
+            return image
+        width = max(size[0] for size in sizes)
+        height = max(size[1] for size in sizes)
+        return self._draft(image, width, height)
+
+    def get_draft_size(self, image, geometry, options):
+        """
+        Returns the smallest size the image can be loaded at for
+        ``geometry`` or ``None`` if it needs the full size.
+        """
+        x_image, y_image = map(float, self.get_image_size(image))
+        factors = [(geometry[0] / x_image, geometry[1] / y_image)]
+        if options.get('orientation', settings.THUMBNAIL_ORIENTATION):
+            # We don't know yet if the orientation will swap width and height
+            factors.append((geometry[1] / x_image, geometry[0] / y_image))
+        if options['crop']:
+            factor = max(max(f) for f in factors)
+        else:
+            factor = max(min(f) for f in factors)
+        if factor >= 1:
+            return None
+        return toint(x_image * factor), toint(y_image * factor)
+
+    def decode(self, image, geometry, options):
+        """
+        Wrapper for ``_decode``
+        """
+        return self._decode(image)
+
     def orientation(self, image, geometry, options):
         """
         Wrapper for ``_orientation``
@@ -33,6 +114,31 @@ class EngineBase(object):
         colorspace = options['colorspace']
         return self._colorspace(image, colorspace)
 
+    def precrop(self, image, geometry, options):
+        """
+        Crops the part of the image that ends up in a cropped thumbnail before
+        scaling, so that only that part is scaled. The region is rounded
+        outwards to whole source pixels, the final crop trims the rest.
+        """
+        crop = options['crop']
+        if not crop or crop == 'noop' or not self.can_precrop(image):
+            return image
+        x_image, y_image = self.get_image_size(image)
+        factor = max(float(geometry[0]) / x_image,
+                     float(geometry[1]) / y_image)
+        if factor >= 1:
+            return image
+        width = min(int(math.ceil(geometry[0] / factor)), x_image)
+        height = min(int(math.ceil(geometry[1] / factor)), y_image)
+        if width == x_image and height == y_image:
+            return image
+        # Offsets of the crop in the scaled image mapped back to the source
+        scaled = (toint(x_image * factor), toint(y_image * factor))
+        x_offset, y_offset = parse_crop(crop, scaled, geometry)
+        x_offset = min(int(x_offset / factor), x_image - width)
+        y_offset = min(int(y_offset / factor), y_image - height)
+        return self._crop(image, width, height, x_offset, y_offset)
+
     def scale(self, image, geometry, options):
         """
         Wrapper for ``_scale``
@@ -68,12 +174,43 @@ class EngineBase(object):
         """
         format_ = options['format']
         quality = options['quality']
-        # additional non-default-value options:
-        progressive = options.get('progressive', settings.THUMBNAIL_PROGRESSIVE)
-        raw_data = self._get_raw_data(image, format_, quality,
-            progressive=progressive
-            )
-        thumbnail.write(raw_data)
+        encoder_options = self.get_encoder_options(image, options)
+        with metrics.measure('encode') as m:
+            content = self._get_raw_file(image, format_, quality,
+                                         **encoder_options)
+            m.data['bytes_out'] = content.size
+        try:
+            thumbnail.write(content)
+        finally:
+            content.close()
+
+    def get_encoder_options(self, image, options):
+        """
+        Returns the ``progressive`` and ``optimize`` options for encoding
+        ``image``. Options given for the thumbnail are used as they are,
+        otherwise they depend on the number of pixels of the image since
+        progressive encoding takes about twice as long and only makes larger
+        images smaller.
+        """
+        x, y = self.get_image_size(image)
+        pixels = x * y
+        progressive = options.get('progressive')
+        if progressive is None:
+            progressive = (settings.THUMBNAIL_PROGRESSIVE and
+                           pixels >= settings.THUMBNAIL_PROGRESSIVE_MIN_PIXELS)
+        optimize = options.get('optimize')
+        if optimize is None:
+            optimize = pixels >= settings.THUMBNAIL_OPTIMIZE_MIN_PIXELS
+        return {'progressive': progressive, 'optimize': optimize}
+
+    def write_many(self, images, options):
+        """
+        Writes the thumbnails for all ``(image, thumbnail)`` pairs in
+        ``images``, which are created from the same source. Engines that can
+        encode several thumbnails at once can override this.
+        """
+        for image, thumbnail in images:
+            self.write(image, options, thumbnail)
 
     def get_image_ratio(self, image):
         """
@@ -82,6 +219,35 @@ class EngineBase(object):
         x, y = self.get_image_size(image)
         return float(x) / y
 
+    def copy_image(self, image):
+        """
+        Returns a copy of the backend image object that can be processed
+        without affecting ``image``. Engines that never modify images in place
+        can return the image it self.
+        """
+        return image
+
+    def cleanup(self, image):
+        """
+        Releases resources held by the backend image object, called when the
+        source image is no longer needed.
+        """
+        pass
+
+    def can_defer_colorspace(self, image, colorspace):
+        """
+        Returns ``True`` if converting ``image`` to ``colorspace`` after
+        scaling and cropping gives the same result as converting it first.
+        """
+        return False
+
+    def can_precrop(self, image):
+        """
+        Returns ``True`` if the engine can crop ``image`` before scaling it
+        and crop it again after that.
+        """
+        return False
+
     #
     # Methods which engines need to implement
     # The ``image`` argument refers to a backend image object
@@ -104,6 +270,22 @@ class EngineBase(object):
         """
         raise NotImplemented()
 
+    def _draft(self, image, width, height):
+        """
+        Lets the engine load the image at a reduced size of at least width x
+        height if the image format supports that. This is called before any
+        other processing.
+        """
+        return image
+
+    def _decode(self, image):
+        """
+        Decodes the image if the engine has not done so in ``get_image``,
+        this is called right after ``_draft`` so that decoding is measured on
+        its own rather than as part of the first stage that needs the pixels.
+        """
+        return image
+
     def _orientation(self, image):
         """
         Read orientation exif data and orientate the image accordingly
@@ -132,10 +314,23 @@ class EngineBase(object):
         """
         raise NotImplemented()
 
-    def _get_raw_data(self, image, format_, quality, progressive=False):
+    def _get_raw_file(self, image, format_, quality, progressive=False,
+                      optimize=True):
+        """
+        Gets the raw data as a ``File`` given the image, format and quality.
+        This method is called from :meth:`write`, engines can override it to
+        encode into a file that is handed to the storage without copying.
+        """
+        return ContentFile(self._get_raw_data(image, format_, quality,
+                                              progressive=progressive,
+                                              optimize=optimize))
+
+    def _get_raw_data(self, image, format_, quality, progressive=False,
+                      optimize=True):
         """
         Gets raw data given the image, format and quality. This method is
-        called from :meth:`write`
+        called from :meth:`_get_raw_file`. ``optimize`` asks for optimized
+        Huffman tables for engines that support it.
         """
         raise NotImplemented()
 
@@ -1,69 +1,187 @@
 from __future__ import with_statement
 import re
 import os
+import time
 from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_str
+from sorl.thumbnail import metrics
 from sorl.thumbnail.base import EXTENSIONS
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.engines.base import EngineBase
+from sorl.thumbnail.helpers import Slots, ThumbnailError
+from sorl.thumbnail.images import HEADER_MAX_SIZE
+from sorl.thumbnail.parsers import parse_image_size, ThumbnailParseError
 from subprocess import Popen, PIPE
+from shutil import copyfileobj
 from tempfile import mkstemp
+from threading import Timer
 
 
 size_re = re.compile(r'^(?:.+) (?:[A-Z]+) (?P<x>\d+)x(?P<y>\d+)')
 
+# Slots for the commands running in this process
+procs = Slots()
+
 
 class Engine(EngineBase):
     """
-    Image object is a dict with source path, options and size
+    Image object is a dict with source path or data, options and size
     """
     def write(self, image, options, thumbnail):
         """
         Writes the thumbnail image
         """
-        handle, out = mkstemp(suffix='.%s' % EXTENSIONS[options['format']])
-        if (
-                options['format'] == 'JPEG' and
-                options.get('progressive', settings.THUMBNAIL_PROGRESSIVE)
-            ):
-            image['options']['interlace'] = 'line'
+        args = self._get_command(settings.THUMBNAIL_CONVERT)
+        source, data = self._get_input(image)
+        args.extend(self._get_read_args([image]))
+        args.append(source)
+        args.extend(self._get_output_args(image, options))
+        with metrics.measure('convert') as m:
+            if settings.THUMBNAIL_CONVERT_PIPE:
+                args.append('%s:-' % options['format'])
+                raw_data = self._run(args, data)
+            else:
+                handle, out = mkstemp(
+                    suffix='.%s' % EXTENSIONS[options['format']])
+                try:
+                    args.append(out)
+                    self._run(args, data)
+                    with open(out, 'rb') as fp:
+                        raw_data = fp.read()
+                finally:
+                    os.close(handle)
+                    os.remove(out)
+            m.data['bytes_out'] = len(raw_data)
+        thumbnail.write(raw_data)
+
+    def write_many(self, images, options):
+        """
+        Writes the thumbnails for all ``(image, thumbnail)`` pairs in
+        ``images`` created from the same source with a single ImageMagick
+        ``convert`` run. The source is decoded once and kept in memory as
+        ``mpr:source``, each thumbnail is written to a temporary file.
+        GraphicsMagick has no image stack so it runs ``convert`` for each.
+        """
+        if (len(images) < 2 or
+                settings.THUMBNAIL_CONVERT.endswith('gm convert')):
+            return super(Engine, self).write_many(images, options)
+        suffix = '.%s' % EXTENSIONS[options['format']]
+        outputs = []
+        args = self._get_command(settings.THUMBNAIL_CONVERT)
+        source, data = self._get_input(images[0][0])
+        args.extend(self._get_read_args([image for image, t in images]))
+        args.extend([source, '-write', 'mpr:source', '+delete'])
+        try:
+            for image, thumbnail in images:
+                outputs.append(mkstemp(suffix=suffix))
+                args.append('mpr:source')
+                args.extend(self._get_output_args(image, options))
+                args.extend(['-write', outputs[-1][1], '+delete'])
+            args.append('null:')
+            with metrics.measure('convert') as m:
+                self._run(args, data)
+                raw_datas = []
+                for handle, out in outputs:
+                    with open(out, 'rb') as fp:
+                        raw_datas.append(fp.read())
+                m.data['bytes_out'] = sum(map(len, raw_datas))
+        finally:
+            for handle, out in outputs:
+                os.close(handle)
+                os.remove(out)
+        for (image, thumbnail), raw_data in zip(images, raw_datas):
+            thumbnail.write(raw_data)
+
+    def _get_read_args(self, images):
+        """
+        Returns the arguments for reading the source, a hint to decode JPEG
+        sources at a reduced size that is large enough for all ``images``.
+        """
+        sizes = [image['draft'] for image in images]
+        if not sizes or None in sizes:
+            return []
+        width = max(x for x, y in sizes)
+        height = max(y for x, y in sizes)
+        if settings.THUMBNAIL_CONVERT.endswith('gm convert'):
+            return ['-size', '%sx%s' % (width, height)]
+        return ['-define', 'jpeg:size=%sx%s' % (width, height)]
+
+    def _get_output_args(self, image, options):
+        """
+        Returns the arguments for processing and encoding ``image``
+        """
+        encoder_options = self.get_encoder_options(image, options)
+        if options['format'] == 'JPEG':
+            # Settings persist across the outputs of a single run so they
+            # are set for every output rather than only when they differ
+            # from the defaults.
+            if encoder_options['progressive']:
+                image['options']['interlace'] = 'line'
+            else:
+                image['options']['interlace'] = 'none'
         image['options']['quality'] = options['quality']
-        args = settings.THUMBNAIL_CONVERT.split(' ')
-        args.append(image['source'])
+        args = []
         for k, v in image['options'].iteritems():
             args.append('-%s' % k)
             if v is not None:
                 args.append('%s' % v)
-        args.append(out)
-        args = map(smart_str, args)
-        p = Popen(args)
-        p.wait()
-        with open(out, 'rb') as fp:
-            thumbnail.write(fp.read())
-        os.close(handle)
-        os.remove(out)
-        os.remove(image['source']) # we should not need this now
+        if (options['format'] == 'JPEG' and
+                not settings.THUMBNAIL_CONVERT.endswith('gm convert')):
+            if encoder_options['optimize']:
+                args.extend(['+define', 'jpeg:optimize-coding'])
+            else:
+                args.extend(['-define', 'jpeg:optimize-coding=false'])
+        return args
 
     def get_image(self, source):
         """
         Returns the backend image objects from a ImageFile instance
         """
+        if settings.THUMBNAIL_CONVERT_PIPE:
+            # The source data is piped to the commands
+            return {'source': None, 'data': source.read(),
+                    'options': SortedDict(), 'size': None, 'draft': None}
         handle, tmp = mkstemp()
-        with open(tmp, 'wb') as fp:
-            fp.write(source.read())
+        src = source.open()
+        try:
+            with open(tmp, 'wb') as fp:
+                copyfileobj(src, fp)
+        finally:
+            src.close()
         os.close(handle)
-        return {'source': tmp, 'options': SortedDict(), 'size': None}
+        return {'source': tmp, 'data': None, 'options': SortedDict(),
+                'size': None, 'draft': None}
+
+    def copy_image(self, image):
+        """
+        Returns a copy of the image dict sharing the same source
+        """
+        return {
+            'source': image['source'],
+            'data': image['data'],
+            'options': SortedDict(image['options']),
+            'size': image['size'],
+            'draft': image['draft'],
+            }
+
+    def cleanup(self, image):
+        """
+        Removes the temporary source file
+        """
+        if image['source'] and os.path.exists(image['source']):
+            os.remove(image['source'])
 
     def get_image_size(self, image):
         """
         Returns the image width and height as a tuple
         """
         if image['size'] is None:
-            args = settings.THUMBNAIL_IDENTIFY.split(' ')
-            args.append(image['source'])
-            p = Popen(args, stdout=PIPE)
-            p.wait()
-            m = size_re.match(p.stdout.read())
+            image['size'] = self._get_header_size(image)
+        if image['size'] is None:
+            args = self._get_command(settings.THUMBNAIL_IDENTIFY)
+            source, data = self._get_input(image)
+            args.append(source)
+            m = size_re.match(self._run(args, data))
             image['size'] = int(m.group('x')), int(m.group('y'))
         return image['size']
 
@@ -72,17 +190,92 @@ class Engine(EngineBase):
         This is not very good for imagemagick because it will say anything is
         valid that it can use as input.
         """
-        handle, tmp = mkstemp()
-        with open(tmp, 'wb') as fp:
-            fp.write(raw_data)
-            fp.flush()
-            args = settings.THUMBNAIL_IDENTIFY.split(' ')
-            args.append(tmp)
-            p = Popen(args)
-            retcode = p.wait()
-        os.close(handle)
-        os.remove(tmp)
-        return retcode == 0
+        args = self._get_command(settings.THUMBNAIL_IDENTIFY)
+        args.append('-')
+        try:
+            self._run(args, raw_data)
+        except ThumbnailError:
+            return False
+        return True
+
+    def _get_header_size(self, image):
+        """
+        Returns the size parsed from the source header or ``None``, this saves
+        running ``identify``.
+        """
+        data = image['data']
+        if data is None:
+            with open(image['source'], 'rb') as fp:
+                data = fp.read(HEADER_MAX_SIZE)
+        try:
+            return parse_image_size(data[:HEADER_MAX_SIZE])
+        except ThumbnailParseError:
+            return None
+
+    def _get_input(self, image):
+        """
+        Returns the input argument for the commands and the data to pipe to
+        them for ``image``
+        """
+        if image['source'] is None:
+            return '-', image['data']
+        return image['source'], None
+
+    def _get_command(self, command):
+        """
+        Returns the arguments for running ``command`` with the resource
+        limits of ``THUMBNAIL_CONVERT_LIMITS``
+        """
+        args = command.split(' ')
+        for resource, limit in sorted(
+                settings.THUMBNAIL_CONVERT_LIMITS.iteritems()):
+            args.extend(['-limit', resource, limit])
+        return args
+
+    def _run(self, args, data=None):
+        """
+        Runs the command ``args`` piping ``data`` to it and returns its
+        output. At most ``THUMBNAIL_CONVERT_MAX_PROCS`` commands run at the
+        same time in this process. Raises ``ThumbnailError`` if the command
+        fails or waiting for it and running it takes longer than
+        ``THUMBNAIL_CONVERT_TIMEOUT`` seconds.
+        """
+        args = map(smart_str, args)
+        timeout = settings.THUMBNAIL_CONVERT_TIMEOUT
+        start = time.time()
+        max_procs = settings.THUMBNAIL_CONVERT_MAX_PROCS
+        if max_procs and not procs.acquire(max_procs, timeout):
+            raise ThumbnailError('Timed out waiting to run `%s`' % args[0])
+        try:
+            p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            timed_out = []
+            def kill():
+                timed_out.append(True)
+                try:
+                    p.kill()
+                except OSError:
+                    pass # already done
+            timer = None
+            if timeout:
+                timer = Timer(max(timeout - (time.time() - start), 0), kill)
+                timer.start()
+            try:
+                # communicate() reads the output while writing the input,
+                # reading a pipe after wait() can deadlock when the pipe
+                # buffer is full
+                out, err = p.communicate(data)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        finally:
+            if max_procs:
+                procs.release()
+        if timed_out:
+            raise ThumbnailError('`%s` timed out after %s seconds' % (
+                args[0], timeout))
+        if p.returncode != 0:
+            raise ThumbnailError('`%s` failed: %s' % (args[0], err.strip()))
+        return out
 
     def _orientation(self, image):
         return image
@@ -129,6 +322,13 @@ class Engine(EngineBase):
         image['options']['colorspace'] = colorspace
         return image
 
+    def _draft(self, image, width, height):
+        """
+        Lets ``convert`` decode JPEG sources at a reduced size
+        """
+        image['draft'] = (width, height)
+        return image
+
     def _crop(self, image, width, height, x_offset, y_offset):
         """
         Crops the image
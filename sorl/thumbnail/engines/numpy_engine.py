@@ -0,0 +1,260 @@
+import numpy
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.engines import pil_engine
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+# Weights of the RGB bands for GRAY, same as PIL
+GRAY_WEIGHTS = numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32)
+
+# Modes the array is kept in, other modes are converted when decoding
+ARRAY_MODES = ('L', 'RGB', 'RGBA', 'CMYK')
+
+# Resampling filter for each THUMBNAIL_RESAMPLE_STRATEGY
+FILTERS = {
+    'antialias': 'lanczos',
+    'reduce': 'box',
+    'fast': 'box',
+}
+
+# Maximum number of cached weights
+MAX_CACHED_WEIGHTS = 64
+
+# Number of output pixels resampled with one matrix product
+BLOCK_SIZE = 64
+
+_weights = {}
+
+
+def lanczos(x):
+    x = numpy.abs(x)
+    return numpy.where(x < 3, numpy.sinc(x) * numpy.sinc(x / 3.0), 0.0)
+
+
+def box(x):
+    return numpy.where((x >= -0.5) & (x < 0.5), 1.0, 0.0)
+
+
+KERNELS = {
+    'lanczos': (lanczos, 3.0),
+    'box': (box, 0.5),
+}
+
+
+def get_weights(size_in, size_out, filter_):
+    """
+    Returns the weights for resampling a row or column of ``size_in`` pixels
+    to ``size_out`` pixels with ``filter_``. The ``size_out`` x ``size_in``
+    weight matrix is mostly zeros so it is split in blocks of
+    ``BLOCK_SIZE`` output pixels, returns a list of ``(start, end, first,
+    last, weights)`` tuples where ``weights`` are the weights of output
+    pixels ``start`` to ``end`` for the input pixels ``first`` to ``last``.
+    Weights are cached since thumbnails are mostly of a few sizes.
+    """
+    key = (size_in, size_out, filter_)
+    if key not in _weights:
+        if len(_weights) >= MAX_CACHED_WEIGHTS:
+            _weights.clear()
+        kernel, support = KERNELS[filter_]
+        scale = float(size_in) / size_out
+        # Widen the kernel when scaling down so that it antialiases
+        filter_scale = max(scale, 1.0)
+        radius = support * filter_scale
+        blocks = []
+        for start in xrange(0, size_out, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, size_out)
+            centers = (numpy.arange(start, end) + 0.5) * scale
+            first = max(int(centers[0] - radius), 0)
+            last = min(int(centers[-1] + radius) + 1, size_in)
+            pixels = numpy.arange(first, last) + 0.5
+            distances = pixels[numpy.newaxis, :] - centers[:, numpy.newaxis]
+            weights = kernel(distances / filter_scale)
+            # Pixels outside the kernel support get no weight, rows sum to one
+            weights[numpy.abs(distances) >= radius] = 0
+            totals = weights.sum(axis=1)
+            totals[totals == 0] = 1
+            weights /= totals[:, numpy.newaxis]
+            blocks.append((start, end, first, last,
+                           weights.astype(numpy.float32)))
+        _weights[key] = blocks
+    return _weights[key]
+
+
+def resample(a, axis, blocks):
+    """
+    Resamples the array ``a`` along ``axis`` 0 or 1 with the weight
+    ``blocks``, each block is a matrix product.
+    """
+    parts = []
+    for start, end, first, last, weights in blocks:
+        if axis == 0:
+            # (out, in) x (in, x, bands) -> (out, x, bands)
+            part = numpy.tensordot(weights, a[first:last], axes=(1, 0))
+        else:
+            # (y, in, bands) x (out, in) -> (y, bands, out)
+            part = numpy.tensordot(a[:, first:last], weights, axes=(1, 1))
+            part = part.transpose(0, 2, 1)
+        parts.append(part)
+    return numpy.concatenate(parts, axis=axis)
+
+
+def get_array_mode(image):
+    """
+    Returns the mode the array of the PIL ``image`` is kept in
+    """
+    if image.mode in ARRAY_MODES:
+        return image.mode
+    if image.mode == 'LA' or (image.mode == 'P' and
+                              'transparency' in image.info):
+        return 'RGBA'
+    return 'RGB'
+
+
+class ArrayImage(object):
+    """
+    Image data as a float32 array of shape (height, width, bands) in
+    ``mode``. An image created from a PIL image decodes it on first use so
+    that the decoder can still be set up for a reduced size.
+    """
+    def __init__(self, array=None, mode=None, source=None, orientation=None):
+        self._array = array
+        self._mode = mode
+        self.source = source
+        self.orientation = orientation
+
+    @property
+    def array(self):
+        if self._array is None:
+            mode = get_array_mode(self.source)
+            image = self.source
+            if image.mode != mode:
+                image = image.convert(mode)
+            array = numpy.asarray(image, dtype=numpy.float32)
+            if array.ndim == 2:
+                array = array[:, :, numpy.newaxis]
+            self._array, self._mode, self.source = array, mode, None
+        return self._array
+
+    @property
+    def mode(self):
+        if self._mode is None:
+            return get_array_mode(self.source)
+        return self._mode
+
+    @property
+    def size(self):
+        if self._array is None:
+            return self.source.size
+        return self._array.shape[1], self._array.shape[0]
+
+    def derive(self, array, mode=None):
+        """
+        Returns a new image of ``array`` in ``mode`` or the same mode
+        """
+        return ArrayImage(array, mode or self.mode)
+
+    def to_pil(self):
+        """
+        Returns the image as a PIL image
+        """
+        if self._array is None:
+            # Not processed, no need to go through an array
+            mode = get_array_mode(self.source)
+            if self.source.mode != mode:
+                return self.source.convert(mode)
+            return self.source
+        array = numpy.rint(numpy.clip(self.array, 0, 255)).astype(numpy.uint8)
+        if array.shape[2] == 1:
+            array = array[:, :, 0]
+        return Image.fromarray(array, self.mode)
+
+
+class Engine(pil_engine.Engine):
+    """
+    Resamples with separable precomputed kernels applied as matrix products
+    to NumPy arrays, PIL is only used to decode and encode images.
+    """
+    def get_image(self, source):
+        image = super(Engine, self).get_image(source)
+        try:
+            exif = image._getexif()
+        except (AttributeError, KeyError, IndexError, IOError):
+            exif = None
+        orientation = exif and exif.get(0x0112)
+        return ArrayImage(source=image, orientation=orientation)
+
+    def get_image_size(self, image):
+        return image.size
+
+    def cleanup(self, image):
+        if image.source is not None:
+            super(Engine, self).cleanup(image.source)
+
+    def can_defer_colorspace(self, image, colorspace):
+        return image.mode in pil_engine.DEFERRABLE_MODES
+
+    def _draft(self, image, width, height):
+        if image.source is not None:
+            image.source.draft(image.source.mode, (width, height))
+        return image
+
+    def _decode(self, image):
+        image.array
+        return image
+
+    def _orientation(self, image):
+        a = image.array
+        if image.orientation == 2:
+            a = a[:, ::-1]
+        elif image.orientation == 3:
+            a = a[::-1, ::-1]
+        elif image.orientation == 4:
+            a = a[::-1]
+        elif image.orientation == 5:
+            a = a.transpose(1, 0, 2)
+        elif image.orientation == 6:
+            a = a.transpose(1, 0, 2)[:, ::-1]
+        elif image.orientation == 7:
+            a = a.transpose(1, 0, 2)[::-1, ::-1]
+        elif image.orientation == 8:
+            a = a.transpose(1, 0, 2)[::-1]
+        else:
+            return image
+        return image.derive(a)
+
+    def _colorspace(self, image, colorspace):
+        a = image.array
+        mode = image.mode
+        if mode == 'CMYK' and colorspace in ('RGB', 'GRAY'):
+            # Same as PIL
+            a = (255 - a[:, :, :3]) * (255 - a[:, :, 3:]) / 255
+            mode = 'RGB'
+        if colorspace == 'RGB':
+            if mode == 'L':
+                return image.derive(a.repeat(3, axis=2), 'RGB')
+            return image.derive(a, mode)
+        if colorspace == 'GRAY':
+            if mode == 'L':
+                return image
+            a = numpy.dot(a[:, :, :3], GRAY_WEIGHTS)[:, :, numpy.newaxis]
+            return image.derive(a, 'L')
+        return image
+
+    def _scale(self, image, width, height):
+        filter_ = FILTERS[settings.THUMBNAIL_RESAMPLE_STRATEGY]
+        a = image.array
+        a = resample(a, 0, get_weights(a.shape[0], height, filter_))
+        a = resample(a, 1, get_weights(a.shape[1], width, filter_))
+        return image.derive(a)
+
+    def _crop(self, image, width, height, x_offset, y_offset):
+        a = image.array[y_offset:y_offset + height, x_offset:x_offset + width]
+        return image.derive(a)
+
+    def _encode(self, image, fp, format_, quality, progressive, optimize):
+        super(Engine, self)._encode(image.to_pil(), fp, format_, quality,
+                                    progressive, optimize)
@@ -1,29 +1,54 @@
+import os
+from django.utils.encoding import smart_str
 from pgmagick import Blob, ColorspaceType, Geometry, Image, ImageType
 from pgmagick import InterlaceType, OrientationType
 from sorl.thumbnail.engines.base import EngineBase
 
 try:
+    # Returns the blob data without copying it through base64
     from pgmagick._pgmagick import get_blob_data
 except ImportError:
-    from base64 import b64decode
-    def get_blob_data(blob):
-        return b64decode(blob.base64())
+    if hasattr(Blob, 'data'):
+        def get_blob_data(blob):
+            return blob.data
+    else:
+        from base64 import b64decode
+        def get_blob_data(blob):
+            return b64decode(blob.base64())
+
+
+def get_source_path(source):
+    """
+    Returns the local path of ``source`` if GraphicsMagick can read it
+    directly or ``None``.
+    """
+    try:
+        path = source.storage.path(source.name)
+    except (AttributeError, NotImplementedError):
+        return None
+    # GraphicsMagick reads names with a colon as ``format:name``
+    if ':' in path or not os.path.isfile(path):
+        return None
+    return smart_str(path)
 
 
 class Engine(EngineBase):
     def get_image(self, source):
-        blob = Blob()
-        blob.update(source.read())
-        return Image(blob)
+        path = get_source_path(source)
+        if path is not None:
+            # Saves reading the source into Python and copying it to a blob
+            return Image(path)
+        return Image(Blob(source.read()))
+
+    def copy_image(self, image):
+        return Image(image)
 
     def get_image_size(self, image):
         geometry = image.size()
         return geometry.width(), geometry.height()
 
     def is_valid_image(self, raw_data):
-        blob = Blob()
-        blob.update(raw_data)
-        im = Image(blob)
+        im = Image(Blob(raw_data))
         return im.isValid()
 
     def _orientation(self, image):
@@ -66,7 +91,9 @@ class Engine(EngineBase):
         image.crop(geometry)
         return image
 
-    def _get_raw_data(self, image, format_, quality, progressive=False):
+    def _get_raw_data(self, image, format_, quality, progressive=False,
+                      optimize=True):
+        # GraphicsMagick chooses the Huffman tables itself
         image.magick(format_.encode('utf8'))
         image.quality(quality)
         if format_ == 'JPEG' and progressive:
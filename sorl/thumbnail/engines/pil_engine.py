@@ -1,16 +1,52 @@
 from cStringIO import StringIO
+from django.core.files.base import File
+from sorl.thumbnail.conf import settings
 from sorl.thumbnail.engines.base import EngineBase
+from tempfile import SpooledTemporaryFile
 
 try:
-    from PIL import Image, ImageFile, ImageDraw
+    from PIL import Image, ImageDraw
 except ImportError:
-    import Image, ImageFile, ImageDraw
+    import Image, ImageDraw
+
+
+# The smallest factor left for the antialias pass after shrinking the image by
+# an integer factor for each THUMBNAIL_RESAMPLE_STRATEGY, None skips shrinking.
+REDUCE_GAPS = {
+    'antialias': None,
+    'reduce': 3.0,
+    'fast': 1.0,
+}
+
+# Encoded thumbnails larger than this are spooled to a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+# Transpose methods for EXIF orientations
+ORIENTATION_TRANSPOSES = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+# Modes that are resampled well and convert to RGB and GRAY by linear
+# per pixel operations, so converting them after scaling gives the same
+# result. Palette images for example must be converted before resampling.
+DEFERRABLE_MODES = ('RGB', 'RGBA', 'L')
 
 
 class Engine(EngineBase):
     def get_image(self, source):
-        buf = StringIO(source.read())
-        return Image.open(buf)
+        # PIL decodes from the file as it needs the data
+        return Image.open(source.open())
+
+    def cleanup(self, image):
+        # The file is released when the image is loaded, close it otherwise
+        if getattr(image, 'fp', None) is not None:
+            image.fp.close()
 
     def get_image_size(self, image):
         return image.size
@@ -24,6 +60,23 @@ class Engine(EngineBase):
             return False
         return True
 
+    def can_defer_colorspace(self, image, colorspace):
+        return image.mode in DEFERRABLE_MODES
+
+    def can_precrop(self, image):
+        return True
+
+    def _draft(self, image, width, height):
+        # JPEG images are decoded at 1/2, 1/4 or 1/8 scale if that is still
+        # at least width x height, other formats ignore this.
+        image.draft(image.mode, (width, height))
+        return image
+
+    def _decode(self, image):
+        # PIL decodes when the pixels are first needed
+        image.load()
+        return image
+
     def _orientation(self, image):
         try:
             exif = image._getexif()
@@ -31,20 +84,10 @@ class Engine(EngineBase):
             exif = None
         if exif:
             orientation = exif.get(0x0112)
-            if orientation == 2:
-                image = image.transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 3:
-                image = image.rotate(180)
-            elif orientation == 4:
-                image = image.transpose(Image.FLIP_TOP_BOTTOM)
-            elif orientation == 5:
-                image = image.rotate(-90).transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 6:
-                image = image.rotate(-90)
-            elif orientation == 7:
-                image = image.rotate(90).transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 8:
-                image = image.rotate(90)
+            # Lossless transposes, rotate() would resample the image
+            method = ORIENTATION_TRANSPOSES.get(orientation)
+            if method is not None:
+                image = image.transpose(method)
         return image
 
     def _colorspace(self, image, colorspace):
@@ -59,28 +102,69 @@ class Engine(EngineBase):
         return image
 
     def _scale(self, image, width, height):
+        gap = REDUCE_GAPS[settings.THUMBNAIL_RESAMPLE_STRATEGY]
+        if gap is not None:
+            x_image, y_image = image.size
+            factor = int(min(x_image / (width * gap),
+                             y_image / (height * gap)))
+            if factor > 1:
+                image = self._reduce(image, factor)
         return image.resize((width, height), resample=Image.ANTIALIAS)
 
+    def _reduce(self, image, factor):
+        """
+        Shrinks the image by an integer factor averaging factor x factor
+        pixel blocks, this is a lot cheaper than antialias resampling.
+        """
+        if hasattr(image, 'reduce'):
+            return image.reduce(factor)
+        box = getattr(Image, 'BOX', None)
+        if box is None:
+            # Old PIL versions only do the antialias pass
+            return image
+        x_image, y_image = image.size
+        size = (-(-x_image // factor), -(-y_image // factor)) # rounded up
+        return image.resize(size, resample=box)
+
     def _crop(self, image, width, height, x_offset, y_offset):
         return image.crop((x_offset, y_offset,
                            width + x_offset, height + y_offset))
 
-    def _get_raw_data(self, image, format_, quality, progressive=False):
-        ImageFile.MAXBLOCK = 1024 * 1024
+    def _get_raw_file(self, image, format_, quality, progressive=False,
+                      optimize=True):
+        fp = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self._encode(image, fp, format_, quality, progressive, optimize)
+        content = File(fp)
+        content.size = fp.tell()
+        fp.seek(0)
+        return content
+
+    def _get_raw_data(self, image, format_, quality, progressive=False,
+                      optimize=True):
         buf = StringIO()
+        self._encode(image, buf, format_, quality, progressive, optimize)
+        raw_data = buf.getvalue()
+        buf.close()
+        return raw_data
+
+    def _encode(self, image, fp, format_, quality, progressive, optimize):
+        """
+        Encodes the image into the file ``fp``
+        """
         params = {
             'format': format_,
             'quality': quality,
-            'optimize': 1,
         }
+        if optimize:
+            # PIL sizes the encoder buffer for each image when optimizing
+            params['optimize'] = 1
         if format_ == 'JPEG' and progressive:
             params['progressive'] = True
         try:
-            image.save(buf, **params)
+            image.save(fp, **params)
         except IOError:
-            params.pop('optimize')
-            image.save(buf, **params)
-        raw_data = buf.getvalue()
-        buf.close()
-        return raw_data
-
+            # Old PIL versions need a larger buffer to optimize
+            params.pop('optimize', None)
+            fp.seek(0)
+            fp.truncate()
+            image.save(fp, **params)
@@ -1,4 +1,7 @@
+from __future__ import with_statement
 import hashlib
+import threading
+import time
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import smart_str
 from django.utils.importlib import import_module
@@ -9,6 +12,39 @@ class ThumbnailError(Exception):
     pass
 
 
+class Slots(object):
+    """
+    Limits the number of threads of this process doing something at the same
+    time, threads wait for a free slot.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.used = 0
+
+    def acquire(self, limit, timeout=None):
+        """
+        Takes one of ``limit`` slots, waiting at most ``timeout`` seconds for
+        it. Returns ``False`` if no slot got free in time.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        with self.condition:
+            while self.used >= limit:
+                if deadline is False:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.used += 1
+        return True
+
+    def release(self):
+        with self.condition:
+            self.used -= 1
+            self.condition.notify()
+
+
 class SortedJSONEncoder(simplejson.JSONEncoder):
     """
     A json encoder that sorts the dict keys
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 import re
 import urllib2
 from django.core.files.base import File, ContentFile
@@ -8,12 +9,18 @@ from django.utils.functional import LazyObject
 from django.utils import simplejson
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.helpers import ThumbnailError, tokey, get_module_class
-from sorl.thumbnail import default
-from sorl.thumbnail.parsers import parse_geometry
+from sorl.thumbnail import default, metrics
+from sorl.thumbnail.metrics import measure
+from sorl.thumbnail.parsers import parse_geometry, parse_image_size
+from sorl.thumbnail.parsers import ThumbnailParseError
 
 
 url_pat = re.compile(r'^(https?|ftp):\/\/')
 
+# Bytes read at a time and at most when parsing the size from image headers
+HEADER_CHUNK_SIZE = 8 * 1024
+HEADER_MAX_SIZE = 256 * 1024
+
 
 def serialize_image_file(image_file):
     if image_file.size is None:
@@ -27,6 +34,20 @@ def serialize_image_file(image_file):
     return simplejson.dumps(data)
 
 
+def serialize_storage(storage):
+    """
+    Returns the class path of ``storage``
+    """
+    if isinstance(storage, LazyObject):
+        # if storage is wrapped in a lazy object we need to get the real
+        # thing.
+        storage._setup()
+        cls = storage._wrapped.__class__
+    else:
+        cls = storage.__class__
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
 def deserialize_image_file(s):
     data = simplejson.loads(s)
     class LazyStorage(LazyObject):
@@ -104,11 +125,38 @@ class ImageFile(BaseImageFile):
             # optimizes this.
             size = self.storage.image_size(self.name)
         else:
-            # This is the worst case scenario
-            image = default.engine.get_image(self)
-            size = default.engine.get_image_size(image)
+            size = self._read_header_size()
+            if size is None:
+                # This is the worst case scenario
+                image = default.engine.get_image(self)
+                size = default.engine.get_image_size(image)
+                default.engine.cleanup(image)
         self._size = list(size)
 
+    def _read_header_size(self):
+        """
+        Reads just enough of the file to parse the size from the image header.
+        Returns ``None`` if the format is not supported or the size was not
+        found in the first ``HEADER_MAX_SIZE`` bytes.
+        """
+        fp = self.storage.open(self.name)
+        try:
+            data = ''
+            while len(data) < HEADER_MAX_SIZE:
+                chunk = fp.read(HEADER_CHUNK_SIZE)
+                if not chunk:
+                    return None
+                data += chunk
+                try:
+                    size = parse_image_size(data)
+                except ThumbnailParseError:
+                    return None
+                if size is not None:
+                    return size
+            return None
+        finally:
+            fp.close()
+
     @property
     def size(self):
         return self._size
@@ -117,27 +165,47 @@ class ImageFile(BaseImageFile):
     def url(self):
         return self.storage.url(self.name)
 
+    def open(self):
+        """
+        Returns a seekable file-like object to read the image from so that
+        decoders can stream it. Files are read into memory only if the
+        storage can not seek them.
+        """
+        with measure('read') as m:
+            fp = self.storage.open(self.name)
+            try:
+                fp.seek(0)
+            except (AttributeError, IOError, ValueError):
+                try:
+                    data = fp.read()
+                finally:
+                    fp.close()
+                fp = ContentFile(data)
+            if metrics.enabled():
+                try:
+                    m.data['bytes_out'] = fp.size
+                except (AttributeError, IOError, OSError):
+                    pass # the storage does not know the size
+        return fp
+
     def read(self):
-        return self.storage.open(self.name).read()
+        with measure('read') as m:
+            data = self.storage.open(self.name).read()
+            m.data['bytes_out'] = len(data)
+        return data
 
     def write(self, content):
         if not isinstance(content, File):
             content = ContentFile(content)
         self._size = None
-        return self.storage.save(self.name, content)
+        with measure('save', bytes_in=content.size):
+            return self.storage.save(self.name, content)
 
     def delete(self):
         return self.storage.delete(self.name)
 
     def serialize_storage(self):
-        if isinstance(self.storage, LazyObject):
-            # if storage is wrapped in a lazy object we need to get the real
-            # thing.
-            self.storage._setup()
-            cls = self.storage._wrapped.__class__
-        else:
-            cls = self.storage.__class__
-        return '%s.%s' % (cls.__module__, cls.__name__)
+        return serialize_storage(self.storage)
 
     @property
     def key(self):
@@ -147,6 +215,29 @@ class ImageFile(BaseImageFile):
         return serialize_image_file(self)
 
 
+class LazyImageFile(ImageFile):
+    """
+    A thumbnail that trusts its name. The url is computed from the name alone
+    and ``resolve`` is called to look up or create the thumbnail the first
+    time the size is needed.
+    """
+    def __init__(self, file_, storage, resolve):
+        super(LazyImageFile, self).__init__(file_, storage)
+        self._resolve = resolve
+
+    def resolve(self):
+        """
+        Makes sure the thumbnail exists and has a size
+        """
+        if self._size is None:
+            self._size = list(self._resolve().size)
+
+    @property
+    def size(self):
+        self.resolve()
+        return self._size
+
+
 class DummyImageFile(BaseImageFile):
     def __init__(self, geometry_string):
         self.size = parse_geometry(
@@ -1,5 +1,8 @@
+from uuid import uuid4
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.helpers import serialize, deserialize, ThumbnailError
+from sorl.thumbnail.helpers import get_module_class
+from sorl.thumbnail.images import ImageFile
 from sorl.thumbnail.images import serialize_image_file, deserialize_image_file
 
 
@@ -24,23 +27,38 @@ class KVStoreBase(object):
         """
         return self._get(image_file.key)
 
-    def set(self, image_file, source=None):
+    def get_many(self, image_files):
+        """
+        Gets the ``image_files`` from store with one lookup. Returns a list in
+        the same order as ``image_files`` with ``None`` for those not found.
+        """
+        return self._get_many([image_file.key for image_file in image_files])
+
+    def set(self, image_file, source=None, options=None):
         """
         Updates store for the `image_file`. Makes sure the `image_file` has a
-        size set.
+        size set. The ``options`` the thumbnail was created with are stored
+        as well if given.
         """
         image_file.set_size() # make sure its got a size
         self._set(image_file.key, image_file)
+        if options is not None:
+            self._set(image_file.key, options, identity='options')
         if source is not None:
             if not self.get(source):
                 # make sure the source is in kvstore
                 raise ThumbnailError('Cannot add thumbnails for source: `%s` '
                                      'that is not in kvstore.' % source.name)
             # Update the list of thumbnails for source.
-            thumbnails = self._get(source.key, identity='thumbnails') or []
-            thumbnails = set(thumbnails)
-            thumbnails.add(image_file.key)
-            self._set(source.key, list(thumbnails), identity='thumbnails')
+            self._add_thumbnail_key(source.key, image_file.key)
+
+    def set_many(self, image_files, source=None, options=None):
+        """
+        Updates store for all ``image_files`` like :meth:`set`. Override this
+        if the keystore can do that with one round trip.
+        """
+        for image_file in image_files:
+            self.set(image_file, source, options)
 
     def get_or_set(self, image_file):
         cached = self.get(image_file)
@@ -49,6 +67,65 @@ class KVStoreBase(object):
         self.set(image_file)
         return image_file
 
+    def get_thumbnails(self, image_file):
+        """
+        Returns a list of ``(thumbnail, options)`` tuples for the thumbnails
+        of ``image_file`` in store. ``options`` is ``None`` for thumbnails
+        stored without options.
+        """
+        thumbnail_keys = self._get(image_file.key, identity='thumbnails') or []
+        thumbnails = []
+        for thumbnail, options in zip(
+                self._get_many(thumbnail_keys),
+                self._get_many(thumbnail_keys, identity='options')):
+            if thumbnail:
+                thumbnails.append((thumbnail, options))
+        return thumbnails
+
+    def set_request(self, thumbnail, source, geometry_string, options):
+        """
+        Stores the ``source``, ``geometry_string`` and ``options`` that
+        ``thumbnail`` is created from so that it can be created from its name
+        alone, see :meth:`get_request`.
+        """
+        request = {
+            'source': source.name,
+            'storage': source.serialize_storage(),
+            'geometry': geometry_string,
+            'options': options,
+        }
+        self._set(thumbnail.key, request, identity='request')
+
+    def get_request(self, thumbnail):
+        """
+        Returns the ``(source, geometry_string, options)`` stored for
+        ``thumbnail`` with :meth:`set_request` or ``None``.
+        """
+        request = self._get(thumbnail.key, identity='request')
+        if request is None:
+            return None
+        storage = get_module_class(request['storage'])()
+        return (ImageFile(request['source'], storage), request['geometry'],
+                request['options'])
+
+    def lock(self, image_file, timeout):
+        """
+        Tries to acquire a lock for creating ``image_file`` that expires after
+        ``timeout`` seconds. Returns a token for :meth:`unlock` if the lock was
+        acquired and ``None`` otherwise.
+        """
+        token = uuid4().hex
+        if self._lock_raw(add_prefix(image_file.key, 'lock'), token, timeout):
+            return token
+        return None
+
+    def unlock(self, image_file, token):
+        """
+        Releases the lock for creating ``image_file`` if it is still held with
+        ``token``, it might have expired and been acquired by someone else.
+        """
+        self._unlock_raw(add_prefix(image_file.key, 'lock'), token)
+
     def delete(self, image_file, delete_thumbnails=True):
         """
         Deletes the referense to the ``image_file`` and deletes the references
@@ -58,6 +135,7 @@ class KVStoreBase(object):
         if delete_thumbnails:
             self.delete_thumbnails(image_file)
         self._delete(image_file.key)
+        self._delete(image_file.key, identity='options')
 
     def delete_thumbnails(self, image_file):
         """
@@ -67,8 +145,7 @@ class KVStoreBase(object):
         if thumbnail_keys:
             # Delete all thumbnail keys from store and delete the
             # thumbnail ImageFiles.
-            for key in thumbnail_keys:
-                thumbnail = self._get(key)
+            for thumbnail in self._get_many(thumbnail_keys):
                 if thumbnail:
                     self.delete(thumbnail)
                     thumbnail.delete() # delete the actual file
@@ -81,6 +158,7 @@ class KVStoreBase(object):
         1. Deletes all key store references for image_files that do not exist
            and all key references for its thumbnails *and* their image_files.
         2. Deletes or updates all invalid thumbnail keys
+        3. Deletes options for thumbnails that are not in store
         """
         for key in self._find_keys(identity='image'):
             image_file = self._get(key)
@@ -94,18 +172,19 @@ class KVStoreBase(object):
                 # if there is an image_file then we check all of its thumbnails
                 # for existence
                 thumbnail_keys = self._get(key, identity='thumbnails') or []
-                thumbnail_keys_set = set(thumbnail_keys)
-                for thumbnail_key in thumbnail_keys:
-                    if not self._get(thumbnail_key):
-                        thumbnail_keys_set.remove(thumbnail_key)
-                thumbnail_keys = list(thumbnail_keys_set)
-                if thumbnail_keys:
-                    self._set(key, thumbnail_keys, identity='thumbnails')
-                    return
+                thumbnails = self._get_many(thumbnail_keys)
+                missing = [thumbnail_key for thumbnail_key, thumbnail in
+                           zip(thumbnail_keys, thumbnails) if not thumbnail]
+                if len(missing) < len(thumbnail_keys):
+                    self._remove_thumbnail_keys(key, missing)
+                    continue
             # if there is no image_file then this thumbnails key is just
             # hangin' loose, If the thumbnail_keys ended up empty there is no
             # reason for keeping it either
             self._delete(key, identity='thumbnails')
+        for key in self._find_keys(identity='options'):
+            if not self._get(key):
+                self._delete(key, identity='options')
 
     def clear(self):
         """
@@ -127,6 +206,21 @@ class KVStoreBase(object):
             return deserialize_image_file(value)
         return deserialize(value)
 
+    def _get_many(self, keys, identity='image'):
+        """
+        Deserializing, prefix wrapper for _get_raw_many
+        """
+        values = self._get_raw_many([add_prefix(key, identity) for key in keys])
+        results = []
+        for value in values:
+            if value is None:
+                results.append(None)
+            elif identity == 'image':
+                results.append(deserialize_image_file(value))
+            else:
+                results.append(deserialize(value))
+        return results
+
     def _set(self, key, value, identity='image'):
         """
         Serializing, prefix wrapper for _set_raw
@@ -143,6 +237,30 @@ class KVStoreBase(object):
         """
         self._delete_raw(add_prefix(key, identity))
 
+    def _add_thumbnail_key(self, key, thumbnail_key):
+        """
+        Adds ``thumbnail_key`` to the thumbnail keys of the source ``key``.
+        Override this if the keystore can add to a set atomically.
+        """
+        thumbnail_keys = set(self._get(key, identity='thumbnails') or [])
+        thumbnail_keys.add(thumbnail_key)
+        self._set(key, list(thumbnail_keys), identity='thumbnails')
+
+    def _remove_thumbnail_keys(self, key, thumbnail_keys):
+        """
+        Removes ``thumbnail_keys`` from the thumbnail keys of the source
+        ``key``. Override this if the keystore can remove from a set
+        atomically.
+        """
+        if not thumbnail_keys:
+            return
+        remaining = set(self._get(key, identity='thumbnails') or [])
+        remaining.difference_update(thumbnail_keys)
+        if remaining:
+            self._set(key, list(remaining), identity='thumbnails')
+        else:
+            self._delete(key, identity='thumbnails')
+
     def _find_keys(self, identity='image'):
         """
         Finds and returns all keys for identity,
@@ -161,6 +279,14 @@ class KVStoreBase(object):
         """
         raise NotImplemented()
 
+    def _get_raw_many(self, keys):
+        """
+        Gets the values for ``keys`` from keystore, returns a list in the same
+        order as ``keys`` with `None` for those not found. Override this if
+        the keystore can get many keys in one round trip.
+        """
+        return [self._get_raw(key) for key in keys]
+
     def _set_raw(self, key, value):
         """
         Sets value associated to key. Key is expected to be shorter than 200
@@ -177,7 +303,20 @@ class KVStoreBase(object):
 
     def _find_keys_raw(self, prefix):
         """
-        Finds all keys with prefix
+        Finds all keys with prefix, returns an iterable
+        """
+        raise NotImplemented()
+
+    def _lock_raw(self, key, value, timeout):
+        """
+        Atomically sets key to value if it does not exist, the key expires
+        after ``timeout`` seconds. Returns ``True`` if the key was set.
         """
         raise NotImplemented()
 
+    def _unlock_raw(self, key, value):
+        """
+        Deletes a key set by :meth:`_lock_raw` if it is still set to value.
+        Silent failure for missing keys.
+        """
+        raise NotImplemented()
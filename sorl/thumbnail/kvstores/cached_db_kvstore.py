@@ -32,6 +32,20 @@ class KVStore(KVStoreBase):
             return None
         return value
 
+    def _get_raw_many(self, keys):
+        values = cache.get_many(keys)
+        missing = [key for key in keys if values.get(key) is None]
+        if missing:
+            qs = KVStoreModel.objects.filter(key__in=missing)
+            found = dict(qs.values_list('key', 'value'))
+            for key in missing:
+                # we set the cache to prevent further db lookups
+                values[key] = found.get(key, EMPTY_VALUE)
+            cache.set_many(dict((key, values[key]) for key in missing),
+                           settings.THUMBNAIL_CACHE_TIMEOUT)
+        return [None if values[key] == EMPTY_VALUE else values[key]
+                for key in keys]
+
     def _set_raw(self, key, value):
         kv = KVStoreModel.objects.get_or_create(key=key)[0]
         kv.value = value
@@ -47,3 +61,11 @@ class KVStore(KVStoreBase):
         qs = KVStoreModel.objects.filter(key__startswith=prefix)
         return qs.values_list('key', flat=True)
 
+    def _lock_raw(self, key, value, timeout):
+        # Locks are short lived so they only go to the cache
+        return cache.add(key, value, timeout)
+
+    def _unlock_raw(self, key, value):
+        # Not atomic but the cache has no compare and delete
+        if cache.get(key) == value:
+            cache.delete(key)
@@ -0,0 +1,164 @@
+from __future__ import with_statement
+import heapq
+import itertools
+import threading
+import time
+from uuid import uuid4
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import ThumbnailError
+from sorl.thumbnail.kvstores.base import add_prefix
+
+
+# Raw key of the generation in the key value store, a new generation
+# invalidates the local caches of all processes
+GENERATION_KEY = add_prefix('local_cache', identity='generation')
+
+
+class LocalCacheKVStore(object):
+    """
+    Keeps the image files got from the wrapped ``kvstore`` deserialized in a
+    process local cache bounded by ``size`` entries that live ``timeout``
+    seconds, the least recently used entries are dropped first. Deleting
+    from the key value store stores a new generation in it, every process
+    drops its cache when it sees a new generation, which it checks at most
+    every ``check_interval`` seconds. All other methods go to ``kvstore``.
+    """
+    def __init__(self, kvstore, size=None, timeout=None, check_interval=None):
+        if size is None:
+            size = settings.THUMBNAIL_KVSTORE_LOCAL_CACHE_SIZE
+        if timeout is None:
+            timeout = settings.THUMBNAIL_KVSTORE_LOCAL_CACHE_TIMEOUT
+        if check_interval is None:
+            check_interval = \
+                settings.THUMBNAIL_KVSTORE_LOCAL_CACHE_CHECK_INTERVAL
+        self.kvstore = kvstore
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._clock = itertools.count()
+        self._generation = None
+        self._checked = None
+
+    def __getattr__(self, name):
+        return getattr(self.kvstore, name)
+
+    def get(self, image_file):
+        return self.get_many([image_file])[0]
+
+    def get_many(self, image_files):
+        self._check_generation()
+        now = time.time()
+        results = []
+        missing = []
+        with self._lock:
+            for i, image_file in enumerate(image_files):
+                entry = self._cache.get(image_file.key)
+                if entry is not None and entry[1] > now:
+                    # entries are [image_file, expires, last used]
+                    entry[2] = self._clock.next()
+                    results.append(entry[0])
+                else:
+                    results.append(None)
+                    missing.append(i)
+        if missing:
+            found = self.kvstore.get_many([image_files[i] for i in missing])
+            for i, image_file in zip(missing, found):
+                results[i] = image_file
+                if image_file is not None:
+                    self._add(image_file)
+        return results
+
+    def set(self, image_file, source=None, options=None):
+        try:
+            self.kvstore.set(image_file, source, options)
+        except ThumbnailError:
+            if source is None:
+                raise
+            self._restore_source(source)
+            self.kvstore.set(image_file, source, options)
+        self._add(image_file)
+
+    def set_many(self, image_files, source=None, options=None):
+        try:
+            self.kvstore.set_many(image_files, source, options)
+        except ThumbnailError:
+            if source is None:
+                raise
+            self._restore_source(source)
+            self.kvstore.set_many(image_files, source, options)
+        for image_file in image_files:
+            self._add(image_file)
+
+    def get_or_set(self, image_file):
+        cached = self.get(image_file)
+        if cached is not None:
+            return cached
+        self.set(image_file)
+        return image_file
+
+    def delete(self, image_file, delete_thumbnails=True):
+        self.kvstore.delete(image_file, delete_thumbnails)
+        self.invalidate()
+
+    def delete_thumbnails(self, image_file):
+        self.kvstore.delete_thumbnails(image_file)
+        self.invalidate()
+
+    def cleanup(self):
+        self.kvstore.cleanup()
+        self.invalidate()
+
+    def clear(self):
+        self.kvstore.clear()
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops the local caches of all processes
+        """
+        generation = uuid4().hex
+        self.kvstore._set_raw(GENERATION_KEY, generation)
+        with self._lock:
+            self._cache.clear()
+            self._generation = generation
+            self._checked = time.time()
+
+    def _check_generation(self):
+        """
+        Drops the local cache if the generation in the key value store changed
+        """
+        now = time.time()
+        if (self._checked is not None and
+                now - self._checked < self.check_interval):
+            return
+        generation = self.kvstore._get_raw(GENERATION_KEY)
+        with self._lock:
+            if generation != self._generation:
+                self._cache.clear()
+                self._generation = generation
+            self._checked = now
+
+    def _restore_source(self, source):
+        """
+        Sets ``source`` in the key value store again, it was found in the
+        local cache but deleted from the store in the meantime.
+        """
+        with self._lock:
+            self._cache.pop(source.key, None)
+        self._add(self.kvstore.get_or_set(source))
+
+    def _add(self, image_file):
+        with self._lock:
+            self._cache[image_file.key] = [image_file,
+                                           time.time() + self.timeout,
+                                           self._clock.next()]
+            if len(self._cache) > self.size:
+                # Drop the least recently used quarter at once so that
+                # this does not happen on every add
+                count = len(self._cache) - self.size * 3 / 4
+                oldest = heapq.nsmallest(count, self._cache.iteritems(),
+                                         key=lambda item: item[1][2])
+                for key, entry in oldest:
+                    del self._cache[key]
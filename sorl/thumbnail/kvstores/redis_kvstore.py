@@ -1,29 +1,198 @@
-from redis import Redis
-from sorl.thumbnail.kvstores.base import KVStoreBase
+from __future__ import with_statement
+import threading
+from redis import Redis, ResponseError
+from redis import BlockingConnectionPool, ConnectionPool
+from redis import UnixDomainSocketConnection
+from sorl.thumbnail.kvstores.base import KVStoreBase, add_prefix
 from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import serialize, deserialize, ThumbnailError
+from sorl.thumbnail.images import serialize_image_file
+
+
+# Number of keys Redis looks at for each SCAN and keys deleted with each DEL
+SCAN_COUNT = 1000
+
+# Deletes a lock only if it still holds the value it was acquired with
+UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_lock = threading.Lock()
+_pool = None
+
+
+def get_connection_pool():
+    """
+    Returns the connection pool shared by all key value stores, creating it
+    on first use.
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            kwargs = {
+                'db': settings.THUMBNAIL_REDIS_DB,
+                'password': settings.THUMBNAIL_REDIS_PASSWORD,
+                'socket_timeout': settings.THUMBNAIL_REDIS_SOCKET_TIMEOUT,
+            }
+            if settings.THUMBNAIL_REDIS_UNIX_SOCKET_PATH:
+                kwargs['connection_class'] = UnixDomainSocketConnection
+                kwargs['path'] = settings.THUMBNAIL_REDIS_UNIX_SOCKET_PATH
+            else:
+                kwargs['host'] = settings.THUMBNAIL_REDIS_HOST
+                kwargs['port'] = settings.THUMBNAIL_REDIS_PORT
+                kwargs['socket_connect_timeout'] = \
+                    settings.THUMBNAIL_REDIS_SOCKET_CONNECT_TIMEOUT
+                kwargs['socket_keepalive'] = \
+                    settings.THUMBNAIL_REDIS_SOCKET_KEEPALIVE
+            if settings.THUMBNAIL_REDIS_MAX_CONNECTIONS:
+                # Wait for a free connection rather than failing
+                _pool = BlockingConnectionPool(
+                    max_connections=settings.THUMBNAIL_REDIS_MAX_CONNECTIONS,
+                    **kwargs)
+            else:
+                _pool = ConnectionPool(**kwargs)
+        return _pool
 
 
 class KVStore(KVStoreBase):
+    """
+    The thumbnail keys of a source are kept in a Redis set so that adding a
+    thumbnail is atomic, all other values are strings.
+    """
     def __init__(self, *args, **kwargs):
         super(KVStore, self).__init__(*args, **kwargs)
-        self.connection = Redis(
-            host=settings.THUMBNAIL_REDIS_HOST,
-            port=settings.THUMBNAIL_REDIS_PORT,
-            db=settings.THUMBNAIL_REDIS_DB,
-            password=settings.THUMBNAIL_REDIS_PASSWORD,
-            unix_socket_path=settings.THUMBNAIL_REDIS_UNIX_SOCKET_PATH,
-            )
+        self.connection = Redis(connection_pool=get_connection_pool())
+
+    def set_many(self, image_files, source=None, options=None):
+        """
+        Sets the ``image_files``, their ``options`` and adds them to the
+        thumbnails of ``source`` with one transaction.
+        """
+        if not image_files:
+            return
+        for image_file in image_files:
+            image_file.set_size() # make sure its got a size
+        pipe = self.connection.pipeline()
+        if source is not None:
+            pipe.exists(add_prefix(source.key))
+        for image_file in image_files:
+            pipe.set(add_prefix(image_file.key),
+                     serialize_image_file(image_file))
+            if options is not None:
+                pipe.set(add_prefix(image_file.key, identity='options'),
+                         serialize(options))
+        if source is None:
+            pipe.execute()
+            return
+        thumbnail_keys = [image_file.key for image_file in image_files]
+        raw_key = add_prefix(source.key, identity='thumbnails')
+        pipe.sadd(raw_key, *thumbnail_keys)
+        results = pipe.execute(raise_on_error=False)
+        if not results[0]:
+            # The thumbnail keys of the source were added anyway, cleanup
+            # deletes them.
+            raise ThumbnailError('Cannot add thumbnails for source: `%s` '
+                                 'that is not in kvstore.' % source.name)
+        if isinstance(results[-1], ResponseError):
+            self._convert_thumbnail_keys(raw_key)
+            self.connection.sadd(raw_key, *thumbnail_keys)
+
+    def clear(self):
+        """
+        Deletes the keys in batches while scanning rather than all at once.
+        """
+        keys = []
+        for key in self._find_keys_raw(settings.THUMBNAIL_KEY_PREFIX):
+            keys.append(key)
+            if len(keys) >= SCAN_COUNT:
+                self._delete_raw(*keys)
+                keys = []
+        if keys:
+            self._delete_raw(*keys)
+
+    def _get(self, key, identity='image'):
+        if identity != 'thumbnails':
+            return super(KVStore, self)._get(key, identity)
+        raw_key = add_prefix(key, identity)
+        try:
+            thumbnail_keys = self.connection.smembers(raw_key)
+        except ResponseError:
+            thumbnail_keys = self._convert_thumbnail_keys(raw_key)
+        return list(thumbnail_keys) or None
+
+    def _set(self, key, value, identity='image'):
+        if identity != 'thumbnails':
+            return super(KVStore, self)._set(key, value, identity)
+        raw_key = add_prefix(key, identity)
+        pipe = self.connection.pipeline()
+        pipe.delete(raw_key)
+        if value:
+            pipe.sadd(raw_key, *value)
+        pipe.execute()
+
+    def _add_thumbnail_key(self, key, thumbnail_key):
+        raw_key = add_prefix(key, identity='thumbnails')
+        try:
+            self.connection.sadd(raw_key, thumbnail_key)
+        except ResponseError:
+            self._convert_thumbnail_keys(raw_key)
+            self.connection.sadd(raw_key, thumbnail_key)
+
+    def _remove_thumbnail_keys(self, key, thumbnail_keys):
+        if not thumbnail_keys:
+            return
+        raw_key = add_prefix(key, identity='thumbnails')
+        try:
+            self.connection.srem(raw_key, *thumbnail_keys)
+        except ResponseError:
+            self._convert_thumbnail_keys(raw_key)
+            self.connection.srem(raw_key, *thumbnail_keys)
+
+    def _convert_thumbnail_keys(self, raw_key):
+        """
+        Converts thumbnail keys stored as a serialized list by earlier
+        versions to a set, returns the thumbnail keys.
+        """
+        try:
+            value = self.connection.get(raw_key)
+        except ResponseError:
+            # Converted by someone else in the meantime
+            return self.connection.smembers(raw_key)
+        thumbnail_keys = value and deserialize(value) or []
+        pipe = self.connection.pipeline()
+        pipe.delete(raw_key)
+        if thumbnail_keys:
+            pipe.sadd(raw_key, *thumbnail_keys)
+        pipe.execute()
+        return thumbnail_keys
 
     def _get_raw(self, key):
         return self.connection.get(key)
 
+    def _get_raw_many(self, keys):
+        if not keys:
+            return []
+        return self.connection.mget(keys)
+
     def _set_raw(self, key, value):
         return self.connection.set(key, value)
 
     def _delete_raw(self, *keys):
+        if not keys:
+            return 0
         return self.connection.delete(*keys)
 
     def _find_keys_raw(self, prefix):
+        # SCAN does not block the server like KEYS does for large databases
         pattern = prefix + '*'
-        return self.connection.keys(pattern=pattern)
+        return self.connection.scan_iter(match=pattern, count=SCAN_COUNT)
+
+    def _lock_raw(self, key, value, timeout):
+        return bool(self.connection.set(key, value, px=int(timeout * 1000),
+                                        nx=True))
 
+    def _unlock_raw(self, key, value):
+        self.connection.eval(UNLOCK_SCRIPT, 1, key, value)
@@ -1,17 +1,107 @@
+from __future__ import with_statement
+import re
+import shlex
+import sys
+import time
+from multiprocessing import Pool
+from optparse import make_option
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import get_model
 from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import get_module_class, serialize
+from sorl.thumbnail.images import ImageFile, serialize_storage
 from sorl.thumbnail import default
+from sorl.thumbnail.parsers import parse_geometry, ThumbnailParseError
+
+
+kw_pat = re.compile(r'^(?P<key>[\w]+)=(?P<value>.+)$')
+
+
+def parse_spec(spec):
+    """
+    Parses a thumbnail spec such as ``'300x200 crop=center quality=80'`` and
+    returns a ``(geometry_string, options)`` tuple.
+    """
+    bits = shlex.split(spec)
+    if not bits:
+        raise CommandError('Empty thumbnail spec')
+    geometry_string = bits[0]
+    try:
+        parse_geometry(geometry_string)
+    except ThumbnailParseError, e:
+        raise CommandError(str(e))
+    options = {}
+    noresolve = {'True': True, 'False': False, 'None': None}
+    for bit in bits[1:]:
+        m = kw_pat.match(bit)
+        if not m:
+            raise CommandError('Invalid option `%s` in thumbnail spec `%s`' %
+                               (bit, spec))
+        value = m.group('value')
+        if value in noresolve:
+            value = noresolve[value]
+        elif value.isdigit():
+            value = int(value)
+        options[m.group('key')] = value
+    return geometry_string, options
+
+
+def warm_chunk(job):
+    """
+    Creates thumbnails for a chunk of sources. This runs in the worker
+    processes. Returns a ``(done, errors, count)`` tuple.
+    """
+    sources, groups = job
+    storages = {}
+    done = []
+    errors = []
+    count = 0
+    for name, storage_path in sources:
+        if storage_path not in storages:
+            storages[storage_path] = get_module_class(storage_path)()
+        source = ImageFile(name, storages[storage_path])
+        try:
+            for options, geometry_strings in groups:
+                # Bypasses THUMBNAIL_LAZY which would create nothing
+                options = dict(options)
+                default.backend._set_default_options(options)
+                default.backend._get_thumbnails(source, geometry_strings,
+                                                options)
+                count += len(geometry_strings)
+        except Exception, e:
+            errors.append((name, '%s: %s' % (e.__class__.__name__, e)))
+        else:
+            done.append(name)
+    return done, errors, count
 
 
 class Command(BaseCommand):
     help = (
         u'Handles thumbnails and key value store'
     )
-    args = '[cleanup, clear]'
-    option_list = BaseCommand.option_list
+    args = '[cleanup, clear, warm [app_label.Model.field ...]]'
+    option_list = BaseCommand.option_list + (
+        make_option('--geometry', action='append', dest='specs', default=[],
+            help='Thumbnail to create when warming, a geometry string '
+                 'optionally followed by options, for example '
+                 '"300x200 crop=center quality=80". Can be given more than '
+                 'once.'),
+        make_option('--files', dest='files', default=None,
+            help='File with one source name per line to warm, use - for '
+                 'stdin.'),
+        make_option('--workers', dest='workers', type='int', default=1,
+            help='Number of worker processes to use when warming.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=50,
+            help='Number of sources handed to a worker at a time.'),
+        make_option('--resume', dest='resume', default=None,
+            help='File to record warmed sources in, sources already '
+                 'recorded are skipped.'),
+    )
 
     def handle(self, cmd, *args, **kwargs):
-        if cmd not in ['cleanup', 'clear']:
+        if cmd not in ['cleanup', 'clear', 'warm']:
             raise CommandError('`%s` is not a valid argument' % cmd)
         if cmd == 'cleanup':
             default.kvstore.cleanup()
@@ -19,4 +109,107 @@ class Command(BaseCommand):
         if cmd == 'clear':
             default.kvstore.clear()
             print 'Cleared the Key Value Store.'
+        if cmd == 'warm':
+            self.warm(args, **kwargs)
+
+    def warm(self, fields, specs, files, workers, chunk_size, resume,
+             **kwargs):
+        """
+        Creates thumbnails for all sources in model ``fields`` and ``files``
+        for all thumbnail ``specs``.
+        """
+        if not specs:
+            raise CommandError('Give at least one --geometry to warm')
+        if not fields and not files:
+            raise CommandError('Give model fields or --files to warm')
+        # Group the specs by options so that all geometries with the same
+        # options are created from a single decode of the source.
+        groups = {}
+        for spec in specs:
+            geometry_string, options = parse_spec(spec)
+            key = serialize(options)
+            groups.setdefault(key, (options.items(), []))
+            groups[key][1].append(geometry_string)
+        groups = groups.values()
+        done = set()
+        if resume:
+            try:
+                with open(resume) as fp:
+                    done = set(line.strip().decode('utf8') for line in fp)
+            except IOError:
+                pass
+        sources = [s for s in self.get_sources(fields, files)
+                   if s[0] not in done]
+        jobs = [(sources[i:i + chunk_size], groups)
+                for i in xrange(0, len(sources), chunk_size)]
+        if workers > 1:
+            # Worker processes must not share the database connection
+            connection.close()
+            pool = Pool(workers)
+            results = pool.imap_unordered(warm_chunk, jobs)
+        else:
+            pool = None
+            results = (warm_chunk(job) for job in jobs)
+        start = time.time()
+        warmed = 0
+        thumbnails = 0
+        failed = 0
+        resume_fp = resume and open(resume, 'a')
+        try:
+            for chunk_done, chunk_errors, count in results:
+                warmed += len(chunk_done) + len(chunk_errors)
+                thumbnails += count
+                failed += len(chunk_errors)
+                for name, error in chunk_errors:
+                    print 'Failed %s: %s' % (name, error)
+                if resume_fp:
+                    for name in chunk_done:
+                        resume_fp.write(name.encode('utf8') + '\n')
+                    resume_fp.flush()
+                print '%s/%s sources, %s thumbnails, %s errors' % (
+                    warmed, len(sources), thumbnails, failed)
+        finally:
+            if resume_fp:
+                resume_fp.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - start
+        print ('Warmed %s thumbnails for %s sources in %.1fs '
+               '(%.1f thumbnails/s), %s errors.' % (
+                   thumbnails, warmed, elapsed,
+                   thumbnails / elapsed if elapsed else 0, failed))
 
+    def get_sources(self, fields, files):
+        """
+        Returns ``(name, storage_path)`` tuples for all sources in model
+        ``fields`` given as ``app_label.Model.field`` and the sources listed
+        in the ``files`` file.
+        """
+        sources = []
+        for field_path in fields:
+            try:
+                app_label, model_name, field_name = field_path.split('.')
+            except ValueError:
+                raise CommandError('`%s` is not of the form '
+                                   'app_label.Model.field' % field_path)
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError('Unknown model `%s`' % field_path)
+            storage = model._meta.get_field(field_name).storage
+            storage_path = serialize_storage(storage)
+            qs = model._default_manager.exclude(**{field_name: ''})
+            qs = qs.order_by('pk').values_list(field_name, flat=True)
+            sources.extend((name, storage_path) for name in qs if name)
+        if files:
+            storage_path = serialize_storage(default_storage)
+            if files == '-':
+                lines = sys.stdin.readlines()
+            else:
+                with open(files) as fp:
+                    lines = fp.readlines()
+            for line in lines:
+                name = line.strip().decode('utf8')
+                if name:
+                    sources.append((name, storage_path))
+        return sources
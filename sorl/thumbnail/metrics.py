@@ -0,0 +1,78 @@
+import time
+from collections import deque
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail import default
+
+
+class MetricsBase(object):
+    """
+    ABC for metrics sinks receiving the duration of each stage of looking up
+    and creating thumbnails.
+    """
+    def record(self, stage, duration, **data):
+        """
+        Records that ``stage`` took ``duration`` seconds. ``data`` holds
+        numbers for the stage such as ``bytes_in``, ``bytes_out``,
+        ``pixels_in``, ``pixels_out`` and ``count``.
+        """
+        raise NotImplemented()
+
+
+class MemoryMetrics(MetricsBase):
+    """
+    Keeps the latest ``max_records`` records in memory.
+    """
+    max_records = 10000
+
+    def __init__(self):
+        self.records = deque(maxlen=self.max_records)
+
+    def record(self, stage, duration, **data):
+        data['stage'] = stage
+        data['duration'] = duration
+        self.records.append(data)
+
+    def summary(self):
+        """
+        Returns a dict with the number of records, total and maximum duration
+        for each stage.
+        """
+        summary = {}
+        for record in list(self.records):
+            stage = summary.setdefault(record['stage'], {
+                'count': 0, 'total': 0.0, 'max': 0.0,
+                })
+            stage['count'] += 1
+            stage['total'] += record['duration']
+            stage['max'] = max(stage['max'], record['duration'])
+        return summary
+
+    def clear(self):
+        self.records.clear()
+
+
+def enabled():
+    """
+    Returns ``True`` if stages should be measured
+    """
+    return bool(settings.THUMBNAIL_METRICS)
+
+
+class measure(object):
+    """
+    Context manager recording the duration of the block it wraps as ``stage``
+    when metrics are enabled. Numbers for the stage can be added to ``data``
+    inside the block.
+    """
+    def __init__(self, stage, **data):
+        self.stage = stage
+        self.data = data
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and enabled():
+            duration = time.time() - self.start
+            default.metrics.record(self.stage, duration, **self.data)
@@ -1,5 +1,6 @@
 #coding=utf-8
 import re
+import struct
 from sorl.thumbnail.helpers import ThumbnailError, toint
 
 
@@ -89,3 +90,82 @@ def parse_crop(crop, xy_image, xy_window):
     offset_y = get_offset(y_crop, xy_image[1] - xy_window[1])
     return offset_x, offset_y
 
+
+# JPEG start of frame markers, all 0xC0-0xCF except DHT, JPG and DAC
+jpeg_sof_markers = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+# JPEG markers without a length field
+jpeg_standalone_markers = set([0x01, 0xD8] + range(0xD0, 0xD8))
+
+
+def parse_image_size(data):
+    """
+    Parses the width and height from the header of JPEG, PNG, GIF, WebP or
+    BMP image data. Returns a (width, height) tuple or ``None`` if ``data``
+    does not contain enough of the header. The size is the size as stored,
+    that is before any EXIF orientation is applied, same as engines report.
+    """
+    def parse_error():
+        return ThumbnailParseError('Cannot parse image size from header')
+    if data.startswith('\x89PNG\r\n\x1a\n'):
+        if len(data) < 24:
+            return None
+        if data[12:16] != 'IHDR':
+            raise parse_error()
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in ('GIF87a', 'GIF89a'):
+        if len(data) < 10:
+            return None
+        return struct.unpack('<HH', data[6:10])
+    if data.startswith('BM'):
+        if len(data) < 26:
+            return None
+        if struct.unpack('<I', data[14:18])[0] == 12:
+            # OS/2 BITMAPCOREHEADER
+            return struct.unpack('<HH', data[18:22])
+        x, y = struct.unpack('<ii', data[18:26])
+        # height is negative for top-down bitmaps
+        return x, abs(y)
+    if data.startswith('RIFF'):
+        if len(data) < 30:
+            return None
+        if data[8:12] != 'WEBP':
+            raise parse_error()
+        chunk = data[12:16]
+        if chunk == 'VP8 ':
+            if data[23:26] != '\x9d\x01\x2a':
+                raise parse_error()
+            x, y = struct.unpack('<HH', data[26:30])
+            return x & 0x3fff, y & 0x3fff
+        if chunk == 'VP8L':
+            bits = struct.unpack('<I', data[21:25])[0]
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == 'VP8X':
+            x = struct.unpack('<I', data[24:27] + '\x00')[0]
+            y = struct.unpack('<I', data[27:30] + '\x00')[0]
+            return x + 1, y + 1
+        raise parse_error()
+    if data.startswith('\xff\xd8'):
+        i = 2
+        while True:
+            # skip fill bytes
+            while i < len(data) and data[i] == '\xff':
+                i += 1
+            if i >= len(data):
+                return None
+            marker = ord(data[i])
+            i += 1
+            if marker in jpeg_standalone_markers:
+                continue
+            if marker in (0xD9, 0xDA):
+                # end of image or start of scan before any frame
+                raise parse_error()
+            if len(data) < i + 7:
+                return None
+            if marker in jpeg_sof_markers:
+                y, x = struct.unpack('>HH', data[i + 3:i + 7])
+                return x, y
+            length = struct.unpack('>H', data[i:i + 2])[0]
+            i += length
+            if i < len(data) and data[i] != '\xff':
+                raise parse_error()
+    raise parse_error()
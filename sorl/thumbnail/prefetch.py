@@ -0,0 +1,47 @@
+"""
+Prefetches thumbnails from the key value store with one lookup so that the
+thumbnail tag does not look them up one by one, for example in a
+``{% for %}`` loop over a listing page.
+"""
+from sorl.thumbnail.helpers import serialize, tokey
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail import default
+
+
+# The context variable holding the prefetched thumbnails
+CONTEXT_VAR = 'sorl_thumbnail_prefetched'
+
+
+def get_key(file_, geometry_string, options):
+    return tokey(ImageFile(file_).key, geometry_string, serialize(options))
+
+
+def prefetch_thumbnails(context, files, geometry_string, **options):
+    """
+    Looks up the thumbnails of ``files`` with ``geometry_string`` and
+    ``options`` in the key value store and adds those found to ``context``.
+    ``context`` can be a template ``Context`` or the dict a view renders a
+    template with. Thumbnails that are not found are left to the thumbnail
+    tag which creates them.
+    """
+    files = [file_ for file_ in files if file_]
+    cached = default.backend.get_cached_thumbnails(
+        [(file_, geometry_string, options) for file_ in files])
+    prefetched = context.get(CONTEXT_VAR)
+    if prefetched is None:
+        prefetched = context[CONTEXT_VAR] = {}
+    for file_, thumbnail in zip(files, cached):
+        if thumbnail is not None:
+            prefetched[get_key(file_, geometry_string, options)] = thumbnail
+    return prefetched
+
+
+def get_prefetched_thumbnail(context, file_, geometry_string, options):
+    """
+    Returns the thumbnail prefetched to ``context`` for ``file_`` with
+    ``geometry_string`` and ``options`` or ``None``.
+    """
+    prefetched = context.get(CONTEXT_VAR)
+    if not prefetched:
+        return None
+    return prefetched.get(get_key(file_, geometry_string, options))
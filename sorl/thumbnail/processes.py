@@ -0,0 +1,141 @@
+"""
+Creates thumbnails in a pool of worker processes so that decoding, scaling and
+encoding do not hold the GIL of the calling process.
+"""
+from __future__ import with_statement
+import os
+import threading
+import time
+from cStringIO import StringIO
+from multiprocessing import Pool, TimeoutError, current_process
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import Slots, ThumbnailError
+from sorl.thumbnail import default
+
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_in_flight = Slots()
+
+
+class SourceData(object):
+    """
+    Stands in for the source ImageFile in the worker processes, engines only
+    read the source.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def open(self):
+        return StringIO(self.data)
+
+    def read(self):
+        return self.data
+
+    def set_size(self, size):
+        self.size = size
+
+
+class ThumbnailData(object):
+    """
+    Stands in for a thumbnail ImageFile in the worker processes, it keeps
+    the data written by the engine.
+    """
+    data = None
+    size = None
+
+    def write(self, content):
+        if hasattr(content, 'read'):
+            content.seek(0)
+            content = content.read()
+        self.data = content
+
+    def set_size(self, size):
+        self.size = size
+
+
+def enabled():
+    """
+    Returns ``True`` if thumbnails should be created in worker processes.
+    Daemonic processes such as the workers of a ``Pool`` can not start worker
+    processes so they create thumbnails themselves.
+    """
+    return (bool(settings.THUMBNAIL_PROCESSES) and
+            not current_process().daemon)
+
+
+def get_pool():
+    """
+    Returns the worker pool of this process, creating it on first use.
+    """
+    global _pool, _pool_pid
+    with _lock:
+        # A forked process can not use the pool of its parent
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = Pool(settings.THUMBNAIL_PROCESSES)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def render(job):
+    """
+    Creates the thumbnails for a ``(data, geometry_strings, options)`` job,
+    this runs in the worker processes. Returns the source size and a list of
+    ``(data, size)`` tuples in the order of ``geometry_strings``, or the
+    exception raised as the third item. Exceptions are returned so that the
+    result callback runs for every job.
+    """
+    data, geometry_strings, options = job
+    source = SourceData(data)
+    thumbnails = [ThumbnailData() for g in geometry_strings]
+    try:
+        default.backend._render_thumbnails(source, zip(geometry_strings,
+                                                       thumbnails), options)
+    except Exception, e:
+        return None, None, e
+    return source.size, [(t.data, t.size) for t in thumbnails], None
+
+
+def release(result):
+    """
+    Frees the slot of a job once the worker process is done with it
+    """
+    _in_flight.release()
+
+
+def create_thumbnails(source, to_create, options):
+    """
+    Creates thumbnails for all ``(geometry_string, thumbnail)`` pairs in
+    ``to_create`` in a worker process and writes them from the calling
+    process. Raises ``ThumbnailError`` if that takes longer than
+    ``THUMBNAIL_PROCESS_TIMEOUT`` seconds.
+    """
+    deadline = time.time() + settings.THUMBNAIL_PROCESS_TIMEOUT
+    data = source.read()
+    geometry_strings = [geometry_string for geometry_string, t in to_create]
+    max_in_flight = (settings.THUMBNAIL_PROCESS_MAX_IN_FLIGHT or
+                     settings.THUMBNAIL_PROCESSES * 2)
+    if not _in_flight.acquire(max_in_flight, deadline - time.time()):
+        raise ThumbnailError('Timed out waiting for a free thumbnail worker '
+                             'process')
+    try:
+        # The slot is freed when the job is done rather than when we stop
+        # waiting for it, the worker keeps running timed out jobs.
+        result = get_pool().apply_async(
+            render, [(data, geometry_strings, options)], callback=release)
+    except Exception:
+        _in_flight.release()
+        raise
+    try:
+        size, rendered, error = result.get(max(deadline - time.time(), 0))
+    except TimeoutError:
+        raise ThumbnailError('Timed out creating thumbnails for %s' %
+                             source.name)
+    if error is not None:
+        raise error
+    source.set_size(size)
+    for (geometry_string, thumbnail), (data, size) in zip(to_create,
+                                                          rendered):
+        thumbnail.write(data)
+        thumbnail.set_size(size)
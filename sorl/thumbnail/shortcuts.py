@@ -8,6 +8,20 @@ def get_thumbnail(file_, geometry_string, **options):
     return default.backend.get_thumbnail(file_, geometry_string, **options)
 
 
+def get_thumbnails(file_, geometry_strings, **options):
+    """
+    A shortcut for the Backend ``get_thumbnails`` method
+    """
+    return default.backend.get_thumbnails(file_, geometry_strings, **options)
+
+
+def get_cached_thumbnails(requests):
+    """
+    A shortcut for the Backend ``get_cached_thumbnails`` method
+    """
+    return default.backend.get_cached_thumbnails(requests)
+
+
 def delete(file_, delete_file=True):
     """
     A shortcut for the Backend ``delete`` method
@@ -2,11 +2,14 @@ import logging
 import re
 import sys
 from django.template import Library, Node, NodeList, TemplateSyntaxError
+from django.template import Variable, VariableDoesNotExist
 from django.utils.encoding import smart_str
 from functools import wraps
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.images import ImageFile, DummyImageFile
 from sorl.thumbnail import default
+from sorl.thumbnail.prefetch import get_prefetched_thumbnail
+from sorl.thumbnail.prefetch import prefetch_thumbnails
 from sorl.thumbnail.parsers import parse_geometry
 
 
@@ -34,6 +37,36 @@ def safe_filter(error_output=''):
     return inner
 
 
+def compile_options(parser, bits, error_msg):
+    """
+    Compiles the ``key=value`` option ``bits`` of a tag
+    """
+    options = []
+    for bit in bits:
+        m = kw_pat.match(bit)
+        if not m:
+            raise TemplateSyntaxError(error_msg)
+        key = smart_str(m.group('key'))
+        expr = parser.compile_filter(m.group('value'))
+        options.append((key, expr))
+    return options
+
+
+def resolve_options(options, context):
+    """
+    Resolves options compiled with :func:`compile_options` in ``context``
+    """
+    resolved = {}
+    for key, expr in options:
+        noresolve = {u'True': True, u'False': False, u'None': None}
+        value = noresolve.get(unicode(expr), expr.resolve(context))
+        if key == 'options':
+            resolved.update(value)
+        else:
+            resolved[key] = value
+    return resolved
+
+
 class ThumbnailNodeBase(Node):
     """
     A Node that renders safely
@@ -65,14 +98,7 @@ class ThumbnailNode(ThumbnailNodeBase):
             raise TemplateSyntaxError(self.error_msg)
         self.file_ = parser.compile_filter(bits[1])
         self.geometry = parser.compile_filter(bits[2])
-        self.options = []
-        for bit in bits[3:-2]:
-            m = kw_pat.match(bit)
-            if not m:
-                raise TemplateSyntaxError(self.error_msg)
-            key = smart_str(m.group('key'))
-            expr = parser.compile_filter(m.group('value'))
-            self.options.append((key, expr))
+        self.options = compile_options(parser, bits[3:-2], self.error_msg)
         self.as_var = bits[-1]
         self.nodelist_file = parser.parse(('empty', 'endthumbnail',))
         if parser.next_token().contents == 'empty':
@@ -82,20 +108,16 @@ class ThumbnailNode(ThumbnailNodeBase):
     def _render(self, context):
         file_ = self.file_.resolve(context)
         geometry = self.geometry.resolve(context)
-        options = {}
-        for key, expr in self.options:
-            noresolve = {u'True': True, u'False': False, u'None': None}
-            value = noresolve.get(unicode(expr), expr.resolve(context))
-            if key == 'options':
-                options.update(value)
-            else:
-                options[key] = value
+        options = resolve_options(self.options, context)
         if settings.THUMBNAIL_DUMMY:
             thumbnail = DummyImageFile(geometry)
         elif file_:
-            thumbnail = default.backend.get_thumbnail(
-                file_, geometry, **options
-                )
+            thumbnail = get_prefetched_thumbnail(context, file_, geometry,
+                                                 options)
+            if thumbnail is None:
+                thumbnail = default.backend.get_thumbnail(
+                    file_, geometry, **options
+                    )
         else:
             return self.nodelist_empty.render(context)
         context.push()
@@ -119,6 +141,48 @@ def thumbnail(parser, token):
     return ThumbnailNode(parser, token)
 
 
+class ThumbnailPrefetchNode(ThumbnailNodeBase):
+    error_msg = ('Syntax error. Expected: ``thumbnail_prefetch items field '
+                 'geometry [key1=val1 key2=val2...]``')
+
+    def __init__(self, parser, token):
+        bits = token.split_contents()
+        if len(bits) < 4:
+            raise TemplateSyntaxError(self.error_msg)
+        self.items = parser.compile_filter(bits[1])
+        self.field = parser.compile_filter(bits[2])
+        self.geometry = parser.compile_filter(bits[3])
+        self.options = compile_options(parser, bits[4:], self.error_msg)
+
+    def _render(self, context):
+        if settings.THUMBNAIL_DUMMY:
+            return ''
+        items = self.items.resolve(context) or []
+        field = self.field.resolve(context)
+        geometry = self.geometry.resolve(context)
+        options = resolve_options(self.options, context)
+        if field:
+            field = Variable(field)
+            files = []
+            for item in items:
+                try:
+                    files.append(field.resolve(item))
+                except VariableDoesNotExist:
+                    pass
+        else:
+            files = list(items)
+        prefetch_thumbnails(context, files, geometry, **options)
+        return ''
+
+    def __repr__(self):
+        return "<ThumbnailPrefetchNode>"
+
+
+@register.tag
+def thumbnail_prefetch(parser, token):
+    return ThumbnailPrefetchNode(parser, token)
+
+
 @safe_filter(error_output=False)
 @register.filter
 def is_portrait(file_):
@@ -0,0 +1,7 @@
+from django.conf.urls.defaults import patterns, url
+
+
+urlpatterns = patterns('',
+    url(r'^(?P<name>.+)$', 'sorl.thumbnail.views.lazy_thumbnail',
+        name='thumbnail_lazy'),
+)
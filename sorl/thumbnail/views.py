@@ -0,0 +1,13 @@
+from django.http import Http404, HttpResponseRedirect
+from sorl.thumbnail import default
+
+
+def lazy_thumbnail(request, name):
+    """
+    Creates the lazy thumbnail ``name`` that is missing from the storage and
+    redirects to it, see ``THUMBNAIL_LAZY``.
+    """
+    thumbnail = default.backend.get_lazy_thumbnail(name)
+    if thumbnail is None:
+        raise Http404('No thumbnail request for %s' % name)
+    return HttpResponseRedirect(thumbnail.url)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""
+Benchmarks the engines and the backend of sorl-thumbnail on synthetic sources
+and writes the results as JSON.
+"""
+from __future__ import with_statement
+import os
+import resource
+import shutil
+import sys
+import time
+from distutils.spawn import find_executable
+from multiprocessing import Process, Queue
+from os.path import abspath, dirname, join as pjoin
+
+
+SIZES = {
+    '0.3': (640, 480),
+    '2': (1600, 1200),
+    '12': (4000, 3000),
+    '24': (6000, 4000),
+}
+FORMATS = ('JPEG', 'PNG', 'GIF')
+ENGINES = {
+    'pil': 'sorl.thumbnail.engines.pil_engine.Engine',
+    'pgmagick': 'sorl.thumbnail.engines.pgmagick_engine.Engine',
+    'convert': 'sorl.thumbnail.engines.convert_engine.Engine',
+    'numpy': 'sorl.thumbnail.engines.numpy_engine.Engine',
+}
+EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'GIF': 'gif',
+}
+# Engines that encode with PIL and the options their encoding is measured with,
+# None lets the engine choose
+ENCODE_ENGINES = ('pil', 'numpy')
+ENCODE_WIDTHS = (80, 300, 1200)
+ENCODER_OPTIONS = (
+    None,
+    {'optimize': False, 'progressive': False},
+    {'optimize': True, 'progressive': False},
+    {'optimize': True, 'progressive': True},
+)
+# Thumbnail format for each source format, PNG keeps the alpha channel
+THUMBNAIL_FORMATS = {
+    'JPEG': 'JPEG',
+    'PNG': 'PNG',
+    'GIF': 'JPEG',
+}
+
+
+def setup_django(settings_module):
+    here = abspath(dirname(__file__))
+    root = pjoin(here, os.pardir)
+    sys.path[0:0] = [ here, root, pjoin(root, 'sorl') ]
+    os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def make_source(size, format_, path):
+    """
+    Saves a synthetic photo like image of ``size`` in ``format_`` to ``path``.
+    JPEG sources are RGB, PNG sources RGBA and GIF sources palette images.
+    """
+    from PIL import Image
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 64)
+    bands = [
+        Image.blend(gradient, noise, 0.3),
+        Image.blend(gradient.rotate(180), noise, 0.5),
+        Image.blend(gradient.transpose(Image.FLIP_TOP_BOTTOM), noise, 0.2),
+    ]
+    im = Image.merge('RGB', bands)
+    if format_ == 'PNG':
+        im.putalpha(gradient.transpose(Image.FLIP_LEFT_RIGHT))
+    elif format_ == 'GIF':
+        im = im.convert('P', palette=Image.ADAPTIVE)
+    im.save(path, format_)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def measure(func, repeat, setup=None):
+    """
+    Runs ``func`` ``repeat`` times and returns the timings. ``setup`` is
+    called before each run and is not timed.
+    """
+    timings = []
+    for i in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return timings
+
+
+def run_case(queue, case, repeat):
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        run = case.pop('run')()
+        case.update(run.pop('info', {}))
+        teardown = run.pop('teardown', None)
+        try:
+            timings = measure(repeat=repeat, **run)
+        finally:
+            if teardown is not None:
+                teardown()
+    except Exception, e:
+        case['error'] = '%s: %s' % (e.__class__.__name__, e)
+        queue.put(case)
+        return
+    total = sum(timings)
+    case.update({
+        'repeat': repeat,
+        'throughput': repeat / total if total else None,
+        'mean': total / repeat,
+        'p50': percentile(timings, 50),
+        'p99': percentile(timings, 99),
+        'base_rss_kb': base_rss,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+    queue.put(case)
+
+
+def run_isolated(case, repeat):
+    """
+    Runs a case in a child process so that peak memory usage is measured for
+    that case alone.
+    """
+    queue = Queue()
+    p = Process(target=run_case, args=(queue, case, repeat))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def engine_case(engine_path, source_name, geometry_string, options):
+    """
+    Creates and writes a thumbnail with the engine directly.
+    """
+    def run():
+        from sorl.thumbnail import default
+        from sorl.thumbnail.base import ThumbnailBackend
+        from sorl.thumbnail.helpers import get_module_class
+        from sorl.thumbnail.images import ImageFile
+        from sorl.thumbnail.parsers import parse_geometry
+        engine = get_module_class(engine_path)()
+        source = ImageFile(source_name)
+        thumbnail = ImageFile('bench/thumbnail', default.storage)
+        ThumbnailBackend()._set_default_options(options)
+        def func():
+            image = engine.get_image(source)
+            ratio = engine.get_image_ratio(image)
+            geometry = parse_geometry(geometry_string, ratio)
+            image = engine.create(image, geometry, options)
+            engine.write(image, options, thumbnail)
+            engine.cleanup(image)
+        return {'func': func, 'setup': thumbnail_cleanup(thumbnail)}
+    return run
+
+
+def encode_case(engine_path, source_name, width, format_, encoder_options):
+    """
+    Encodes a thumbnail ``width`` pixels wide with the engine, ``None``
+    encoder options are chosen by the engine. The size of the encoded
+    thumbnail is added to the results.
+    """
+    def run():
+        from sorl.thumbnail.helpers import get_module_class
+        from sorl.thumbnail.images import ImageFile
+        engine = get_module_class(engine_path)()
+        image = engine.get_image(ImageFile(source_name))
+        height = int(width / engine.get_image_ratio(image))
+        options = {'crop': False, 'colorspace': 'RGB', 'upscale': False}
+        image = engine.create(image, (width, height), options)
+        if encoder_options is None:
+            kwargs = engine.get_encoder_options(image, {})
+        else:
+            kwargs = encoder_options
+        def func():
+            return engine._get_raw_file(image, format_, 95, **kwargs)
+        info = dict(kwargs, width=width, bytes=func().size)
+        return {'func': func, 'info': info}
+    return run
+
+
+def thumbnail_cleanup(thumbnail):
+    def setup():
+        if thumbnail.exists():
+            thumbnail.delete()
+    return setup
+
+
+def backend_case(source_name, geometry_string, options, warm):
+    """
+    Gets a thumbnail through the backend with a warm or a cold key value
+    store.
+    """
+    def run():
+        from sorl.thumbnail import default
+        from sorl.thumbnail.images import ImageFile
+        source = ImageFile(source_name)
+        def func():
+            return default.backend.get_thumbnail(source, geometry_string,
+                                                 **options)
+        def delete():
+            # Deletes the thumbnail files as well
+            default.kvstore.delete(source)
+        if warm:
+            func()
+            return {'func': func, 'teardown': delete}
+        return {'func': func, 'setup': delete, 'teardown': delete}
+    return run
+
+
+def blob_case(source_name, method):
+    """
+    Gets the encoded data of a pgmagick image through the direct blob data
+    path or through base64.
+    """
+    def run():
+        from base64 import b64decode
+        from pgmagick import Blob
+        from sorl.thumbnail.engines import pgmagick_engine
+        from sorl.thumbnail.images import ImageFile
+        engine = pgmagick_engine.Engine()
+        image = engine.get_image(ImageFile(source_name))
+        blob = Blob()
+        image.write(blob)
+        if method == 'direct':
+            get_blob_data = pgmagick_engine.get_blob_data
+        else:
+            get_blob_data = lambda blob: b64decode(blob.base64())
+        return {'func': lambda: get_blob_data(blob)}
+    return run
+
+
+def get_engines(names):
+    from sorl.thumbnail.conf import settings
+    available = []
+    for name in names:
+        if name == 'pgmagick':
+            try:
+                import pgmagick
+            except ImportError:
+                continue
+        if name == 'numpy':
+            try:
+                import numpy
+            except ImportError:
+                continue
+        if name == 'convert':
+            if not find_executable(settings.THUMBNAIL_CONVERT.split()[0]):
+                continue
+        available.append(name)
+    return available
+
+
+def runbenchmarks(settings_module, engines, sizes, formats, repeat,
+                  geometry_string):
+    setup_django(settings_module)
+    from sorl.thumbnail.conf import settings
+    bench_root = pjoin(settings.MEDIA_ROOT, 'bench')
+    if not os.path.exists(bench_root):
+        os.makedirs(bench_root)
+    results = []
+    try:
+        for size_name in sizes:
+            for format_ in formats:
+                name = 'bench/%sMP.%s' % (size_name, EXTENSIONS[format_])
+                make_source(SIZES[size_name], format_,
+                            pjoin(settings.MEDIA_ROOT, name))
+                options = {'format': THUMBNAIL_FORMATS[format_]}
+                info = {
+                    'megapixels': float(size_name),
+                    'format': format_,
+                    'geometry': geometry_string,
+                    'options': options,
+                }
+                for engine in get_engines(engines):
+                    case = dict(info, case='engine', engine=engine)
+                    case['run'] = engine_case(ENGINES[engine], name,
+                                              geometry_string, dict(options))
+                    results.append(run_isolated(case, repeat))
+                for engine in get_engines(
+                        [e for e in engines if e in ENCODE_ENGINES]):
+                    for width in ENCODE_WIDTHS:
+                        for encoder_options in ENCODER_OPTIONS:
+                            case = dict(info, case='encode', engine=engine,
+                                        policy=encoder_options is None)
+                            case['run'] = encode_case(
+                                ENGINES[engine], name, width,
+                                THUMBNAIL_FORMATS[format_], encoder_options)
+                            results.append(run_isolated(case, repeat))
+                if 'pgmagick' in get_engines(engines):
+                    for method in ('direct', 'base64'):
+                        case = dict(info, case='blob', method=method,
+                                    engine='pgmagick')
+                        case['run'] = blob_case(name, method)
+                        results.append(run_isolated(case, repeat))
+                for warm in (False, True):
+                    case = dict(info, case='backend', warm=warm,
+                                engine=settings.THUMBNAIL_ENGINE)
+                    case['run'] = backend_case(name, geometry_string,
+                                               dict(options), warm)
+                    results.append(run_isolated(case, repeat))
+    finally:
+        shutil.rmtree(bench_root)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Runs the benchmarks for sorl-thumbnail.'
+        )
+    parser.add_argument(
+        '--settings',
+        dest='settings_module',
+        action='store',
+        default='settings.default',
+        help='Specify settings module, sets the engine for backend cases.',
+        )
+    parser.add_argument(
+        '--engines',
+        nargs='+',
+        default=sorted(ENGINES),
+        choices=sorted(ENGINES),
+        help='Engines to benchmark, unavailable engines are skipped.',
+        )
+    parser.add_argument(
+        '--sizes',
+        nargs='+',
+        default=sorted(SIZES, key=float),
+        choices=sorted(SIZES, key=float),
+        help='Source sizes in megapixels.',
+        )
+    parser.add_argument(
+        '--formats',
+        nargs='+',
+        default=list(FORMATS),
+        choices=FORMATS,
+        help='Source formats.',
+        )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='Number of runs per case.',
+        )
+    parser.add_argument(
+        '--geometry',
+        dest='geometry_string',
+        default='300x300',
+        help='Thumbnail geometry.',
+        )
+    parser.add_argument(
+        '--output',
+        default=None,
+        help='File to write the JSON results to, defaults to stdout.',
+        )
+    args = parser.parse_args()
+    results = runbenchmarks(
+        settings_module=args.settings_module,
+        engines=args.engines,
+        sizes=args.sizes,
+        formats=args.formats,
+        repeat=args.repeat,
+        geometry_string=args.geometry_string,
+        )
+    from django.utils import simplejson
+    output = simplejson.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print output
@@ -1,4 +1,4 @@
 from .default import *
 
 
-THUMBNAIL_KVSTORE = 'sorl.thumbnail.kvstores.redis_kvstore.KVStore'
+THUMBNAIL_KVSTORE = 'thumbnail_tests.kvstore.TestRedisKVStore'
@@ -27,6 +27,10 @@ class TestKvStoreMixin(object):
         kvlog.log('get')
         return super(TestKvStoreMixin, self).get(*args, **kwargs)
 
+    def get_many(self, *args, **kwargs):
+        kvlog.log('get_many')
+        return super(TestKvStoreMixin, self).get_many(*args, **kwargs)
+
     def set(self, *args, **kwargs):
         kvlog.log('set')
         return super(TestKvStoreMixin, self).set(*args, **kwargs)
@@ -39,3 +43,12 @@ class TestKvStoreMixin(object):
 class TestKVStore(TestKvStoreMixin, KVStore):
     pass
 
+
+try:
+    from sorl.thumbnail.kvstores.redis_kvstore import KVStore as RedisKVStore
+except ImportError:
+    pass
+else:
+    class TestRedisKVStore(TestKvStoreMixin, RedisKVStore):
+        pass
+
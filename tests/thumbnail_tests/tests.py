@@ -1,27 +1,54 @@
 #coding=utf-8
+from __future__ import with_statement
 import logging
 import operator
 import os
 import re
 import shutil
+import time
+from cStringIO import StringIO
+from multiprocessing import Pool
 from PIL import Image
+from django.core.files.base import File
 from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.http import Http404
 from django.template.loader import render_to_string
 from django.test.client import Client
+from django.utils.datastructures import SortedDict
 from django.utils import unittest
 from os.path import join as pjoin
-from sorl.thumbnail import default, get_thumbnail, delete
+from sorl.thumbnail import default, get_thumbnail, delete, processes
 from sorl.thumbnail.conf import settings
+from sorl.thumbnail.engines import convert_engine
+from sorl.thumbnail.engines.convert_engine import Engine as ConvertEngine
+from sorl.thumbnail.engines import pil_engine
 from sorl.thumbnail.engines.pil_engine import Engine as PILEngine
-from sorl.thumbnail.helpers import get_module_class, ThumbnailError
+from sorl.thumbnail.helpers import get_module_class, serialize, ThumbnailError
 from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.local_cache import LocalCacheKVStore
 from sorl.thumbnail.log import ThumbnailLogHandler
-from sorl.thumbnail.parsers import parse_crop, parse_geometry
+from sorl.thumbnail.parsers import parse_crop, parse_geometry, parse_image_size
+from sorl.thumbnail.prefetch import CONTEXT_VAR as PREFETCH_VAR
+from sorl.thumbnail.prefetch import prefetch_thumbnails
 from sorl.thumbnail.templatetags.thumbnail import margin
+from sorl.thumbnail.views import lazy_thumbnail
 from subprocess import Popen, PIPE
+from thumbnail_tests.kvstore import kvlog
 from thumbnail_tests.models import Item
 from thumbnail_tests.storage import slog
 
+try:
+    from sorl.thumbnail.engines import numpy_engine
+except ImportError:
+    numpy_engine = None
+
+try:
+    from sorl.thumbnail.kvstores import redis_kvstore
+except ImportError:
+    redis_kvstore = None
+
 
 handler = ThumbnailLogHandler()
 handler.setLevel(logging.ERROR)
@@ -94,6 +121,29 @@ class ParsersTestCase(unittest.TestCase):
         g = parse_geometry('x999')
         self.assertEqual(g, (None, 999))
 
+    def testImageSize(self):
+        images = [
+            ('JPEG', Image.new('RGB', (301, 203)), {}),
+            ('JPEG', Image.new('L', (301, 203)), {'progressive': True}),
+            ('PNG', Image.new('RGBA', (301, 203)), {}),
+            ('GIF', Image.new('P', (301, 203)), {}),
+            ('BMP', Image.new('RGB', (301, 203)), {}),
+            ('WEBP', Image.new('RGB', (301, 203)), {}),
+            ('WEBP', Image.new('RGB', (301, 203)), {'lossless': True}),
+            ('WEBP', Image.new('RGBA', (301, 203)), {}),
+        ]
+        for format_, im, params in images:
+            buf = StringIO()
+            im.save(buf, format_, **params)
+            self.assertEqual(parse_image_size(buf.getvalue()), (301, 203))
+            self.assertEqual(parse_image_size(buf.getvalue()[:8]), None)
+        for name in os.listdir(settings.DATA_ROOT):
+            with open(pjoin(settings.DATA_ROOT, name), 'rb') as fp:
+                data = fp.read()
+            size = Image.open(pjoin(settings.DATA_ROOT, name)).size
+            self.assertEqual(parse_image_size(data), size)
+        self.assertRaises(ThumbnailError, parse_image_size, 'not an image')
+
 
 class SimpleTestCaseBase(unittest.TestCase):
     def setUp(self):
@@ -162,6 +212,452 @@ class SimpleTestCase(SimpleTestCaseBase):
             self.kvstore._get(im.key, identity='thumbnails')
             )
 
+    def testGetThumbnails(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        slog.start_log()
+        ths = self.backend.get_thumbnails(im, ['40x40', '30', 'x20'])
+        log = slog.stop_log()
+        self.assertEqual([(th.x, th.y) for th in ths], [(40, 40), (30, 30), (20, 20)])
+        self.assertEqual(log.count('open: %s' % im.name), 1)
+        th = self.backend.get_thumbnail(im, '30')
+        self.assertEqual(th.name, ths[1].name)
+        self.assertEqual(
+            set(th.key for th in ths),
+            set(self.kvstore._get(im.key, identity='thumbnails'))
+            )
+        # repeated geometries are only created once
+        slog.start_log()
+        ths = self.backend.get_thumbnails(im, ['25x25', '10', '25x25'])
+        log = slog.stop_log()
+        self.assertEqual([(th.x, th.y) for th in ths], [(25, 25), (10, 10), (25, 25)])
+        self.assertEqual(ths[0].name, ths[2].name)
+        self.assertEqual(len([l for l in log if l.startswith('save: ')]), 2)
+
+    def testGetThumbnailsDraft(self):
+        name = '2000x1500.jpg'
+        Image.new('RGB', (2000, 1500)).save(pjoin(settings.MEDIA_ROOT, name))
+        im = ImageFile(name, default.storage)
+        for options, geometries, sizes in [
+                ({'crop': 'center', 'upscale': False},
+                 ['300x300', '1000x10'], [(300, 300), (1000, 10)]),
+                ({'upscale': False},
+                 ['300x300', '1000x10', 'x1200'],
+                 [(300, 225), (13, 10), (1600, 1200)]),
+            ]:
+            ths = self.backend.get_thumbnails(im, geometries, **options)
+            self.assertEqual([(th.x, th.y) for th in ths], sizes)
+
+    def testGetCachedThumbnails(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        th = self.backend.get_thumbnail(im, '30', crop='center')
+        requests = [
+            (im, '30', {'crop': 'center'}),
+            (im, '31', {}),
+            (None, '30', {}),
+        ]
+        kvlog.start_log()
+        cached = self.backend.get_cached_thumbnails(requests)
+        self.assertEqual(kvlog.stop_log(), ['get_many'])
+        self.assertEqual(cached[0].name, th.name)
+        self.assertEqual(cached[0].size, th.size)
+        self.assertEqual(cached[1:], [None, None])
+        keys = [add_prefix(th.key), add_prefix('missing')]
+        self.assertEqual(self.kvstore._get_raw_many(keys),
+                         [self.kvstore._get_raw(keys[0]), None])
+
+    def testLocalCache(self):
+        ims = [ImageFile(Item.objects.get(image=name).image) for name in
+               ('500x500.jpg', '100x100.jpg', '200x100.jpg')]
+        kvstore = LocalCacheKVStore(self.kvstore, size=2, timeout=60,
+                                    check_interval=0)
+        other = LocalCacheKVStore(self.kvstore, size=2, timeout=60,
+                                  check_interval=60)
+        for im in ims:
+            kvstore.get_or_set(im)
+        kvlog.start_log()
+        self.assertEqual(kvstore.get(ims[2]).size, [200, 100])
+        self.assertEqual(kvlog.stop_log(), [])
+        # the least recently used image files were dropped
+        self.assertEqual(len(kvstore._cache), 1)
+        kvlog.start_log()
+        self.assertEqual(kvstore.get(ims[0]).size, [500, 500])
+        self.assertEqual(kvlog.stop_log(), ['get_many'])
+        # deleting in another process drops the cache
+        other.delete(ims[0])
+        self.assertEqual(kvstore.get(ims[0]), None)
+        self.assertEqual(kvstore._cache.keys(), [])
+        kvstore.timeout = 0
+        kvstore.set(ims[1])
+        kvlog.start_log()
+        self.assertEqual(kvstore.get(ims[1]).size, [100, 100])
+        self.assertEqual(kvlog.stop_log(), ['get_many'])
+        # adding thumbnails does not look up the source once more
+        kvstore.timeout = 60
+        kvstore.get_or_set(ims[0])
+        kvlog.start_log()
+        self.kvstore.set(ims[1], ims[0])
+        log = kvlog.stop_log()
+        kvlog.start_log()
+        kvstore.set(ims[2], ims[0])
+        self.assertEqual(kvlog.stop_log(), log)
+        # a source cached locally but deleted from the store is set again
+        self.kvstore.delete(ims[0])
+        kvstore.set_many([ims[2]], ims[0])
+        self.assertEqual(self.kvstore.get(ims[0]).size, [500, 500])
+        self.assertEqual(self.kvstore._get(ims[0].key, identity='thumbnails'),
+                         [ims[2].key])
+
+    def testOpen(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        fp = im.open()
+        self.assertEqual(Image.open(fp).size, (500, 500))
+        fp.close()
+        class Stream(object):
+            def __init__(self, data):
+                self.read = StringIO(data).read
+            def close(self):
+                pass
+        class StreamStorage(object):
+            def open(self, name):
+                return Stream(default_storage.open(name).read())
+        im = ImageFile(im.name, StreamStorage())
+        fp = im.open()
+        self.assertEqual(fp.size, default_storage.size(im.name))
+        self.assertEqual(Image.open(fp).size, (500, 500))
+        # a seekable file without a name or size
+        class FileStorage(object):
+            def open(self, name):
+                return File(StringIO(default_storage.open(name).read()))
+        im = ImageFile(im.name, FileStorage())
+        self.assertEqual(Image.open(im.open()).size, (500, 500))
+        settings.THUMBNAIL_METRICS = 'sorl.thumbnail.metrics.MemoryMetrics'
+        try:
+            self.assertEqual(Image.open(im.open()).size, (500, 500))
+        finally:
+            settings.THUMBNAIL_METRICS = None
+        default.metrics.clear()
+
+    def testProcesses(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        settings.THUMBNAIL_PROCESSES = 1
+        try:
+            th1, th2 = self.backend.get_thumbnails(im, ['60x60', '30x30'],
+                                                   crop='center')
+            self.assertEqual((th1.x, th1.y), (60, 60))
+            self.assertEqual(Image.open(th2.storage.path(th2.name)).size,
+                             (30, 30))
+            self.kvstore.delete_thumbnails(im)
+            th1.delete()
+            settings.THUMBNAIL_PROCESS_TIMEOUT = 0
+            self.assertRaises(ThumbnailError, self.backend.get_thumbnail, im,
+                              '60x60', crop='center')
+            # the slot is freed when the worker is done with the job
+            for i in xrange(50):
+                if not processes._in_flight.used:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(processes._in_flight.used, 0)
+            # daemonic processes can not start worker processes
+            self.assertTrue(processes.enabled())
+            pool = Pool(1)
+            try:
+                self.assertFalse(pool.apply(processes.enabled))
+            finally:
+                pool.terminate()
+        finally:
+            settings.THUMBNAIL_PROCESSES = 0
+            settings.THUMBNAIL_PROCESS_TIMEOUT = 60
+
+    def testDerive(self):
+        settings.THUMBNAIL_DERIVE = True
+        try:
+            im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+            self.kvstore.delete_thumbnails(im)
+            th1 = self.backend.get_thumbnail(im, '400', format='PNG')
+            th2 = self.backend.get_thumbnail(im, '300x300', crop='center')
+            slog.start_log()
+            th3 = self.backend.get_thumbnail(im, '100')
+            th4 = self.backend.get_thumbnail(im, '250')
+            log = slog.stop_log()
+        finally:
+            settings.THUMBNAIL_DERIVE = False
+        self.assertEqual((th3.x, th3.y), (100, 100))
+        self.assertEqual((th4.x, th4.y), (250, 250))
+        opened = [l for l in log if l.startswith('open: ')]
+        self.assertEqual(opened, ['open: %s' % th1.name, 'open: %s' % im.name])
+        # the options of all thumbnails are looked up together
+        keys = []
+        def get_raw(key):
+            keys.append(key)
+            return self.kvstore.__class__._get_raw(self.kvstore, key)
+        self.kvstore._get_raw = get_raw
+        thumbnails = dict((t.name, o) for t, o in
+                          self.kvstore.get_thumbnails(im))
+        self.assertEqual(thumbnails[th1.name]['format'], 'PNG')
+        self.assertEqual(thumbnails[th2.name]['crop'], 'center')
+        self.assertEqual([k for k in keys if 'options' in k], [])
+
+    def testLock(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        token = self.kvstore.lock(im, 10)
+        self.assertTrue(token)
+        self.assertFalse(self.kvstore.lock(im, 10))
+        self.kvstore.unlock(im, token)
+        token = self.kvstore.lock(im, 10)
+        self.assertTrue(token)
+        # an expired lock acquired by someone else is not released
+        self.kvstore.unlock(im, 'stale')
+        self.assertFalse(self.kvstore.lock(im, 10))
+        self.kvstore.unlock(im, token)
+
+    def testLockedThumbnail(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        name = self.backend.get_thumbnail(im, '60x60').name
+        self.kvstore.delete_thumbnails(im)
+        th = ImageFile(name, default.storage)
+        org_settings = settings.THUMBNAIL_LOCK, settings.THUMBNAIL_LOCK_WAIT
+        settings.THUMBNAIL_LOCK, settings.THUMBNAIL_LOCK_WAIT = True, 0.2
+        try:
+            # someone else is creating the thumbnails and never finishes
+            options = {}
+            self.backend._set_default_options(options)
+            th2 = ImageFile(self.backend._get_thumbnail_filename(
+                im, '30x30', options), default.storage)
+            tokens = [self.kvstore.lock(th, 10), self.kvstore.lock(th2, 10)]
+            start = time.time()
+            th, th2 = self.backend.get_thumbnails(im, ['60x60', '30x30'])
+            # the thumbnails are waited for together
+            self.assertTrue(time.time() - start < 0.4)
+            self.assertEqual((th.x, th.y), (60, 60))
+            self.kvstore.unlock(th, tokens[0])
+            self.kvstore.unlock(th2, tokens[1])
+            self.assertEqual(self.kvstore.get(th).x, 60)
+        finally:
+            settings.THUMBNAIL_LOCK, settings.THUMBNAIL_LOCK_WAIT = org_settings
+
+    def testLazy(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        settings.THUMBNAIL_LAZY = True
+        try:
+            kvlog.start_log()
+            slog.start_log()
+            th = self.backend.get_thumbnail(im, '70x70')
+            url = th.url
+            self.assertEqual(kvlog.stop_log(), [])
+            self.assertEqual(slog.stop_log(), [])
+            self.assertEqual((th.x, th.y), (70, 70))
+            self.assertTrue(th.exists())
+            # a thumbnail whose url is requested is created by the view
+            th = self.backend.get_thumbnail(im, '80x80')
+            self.assertFalse(th.exists())
+        finally:
+            settings.THUMBNAIL_LAZY = False
+        self.assertEqual(url, self.backend.get_thumbnail(im, '70x70').url)
+        client = Client()
+        response = client.get('/lazy/%s' % th.name)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(th.url))
+        self.assertTrue(th.exists())
+        self.assertEqual(self.kvstore.get(th).size, [80, 80])
+        self.assertRaises(Http404, lazy_thumbnail, None,
+                          'cache/00/00/missing.jpg')
+
+    def testMetrics(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        settings.THUMBNAIL_METRICS = 'sorl.thumbnail.metrics.MemoryMetrics'
+        try:
+            self.backend.get_thumbnail(im, '50x40', crop='center')
+        finally:
+            settings.THUMBNAIL_METRICS = None
+        records = dict((r['stage'], r) for r in default.metrics.records)
+        self.assertEqual(records['draft']['pixels_in'], 500 * 500)
+        self.assertEqual(records['decode']['pixels_in'], records['draft']['pixels_out'])
+        self.assertEqual(records['precrop']['pixels_in'], records['decode']['pixels_out'])
+        self.assertEqual(records['scale']['pixels_in'], records['precrop']['pixels_out'])
+        self.assertEqual(records['crop']['pixels_out'], 50 * 40)
+        self.assertTrue(records['read']['bytes_out'] > 0)
+        self.assertEqual(records['encode']['bytes_out'], records['save']['bytes_in'])
+        summary = default.metrics.summary()
+        for stage in ('kvstore_get', 'exists', 'get_image', 'decode',
+                      'orientation', 'colorspace', 'kvstore_set'):
+            self.assertEqual(summary[stage]['count'], 1)
+        default.metrics.clear()
+
+    def testDraft(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        for crop, orientation, geometry, size in [
+                (False, False, (100, 60), (63, 63)),
+                ('center', False, (100, 60), (125, 125)),
+                (False, True, (100, 60), (63, 63)),
+                (False, False, (500, 500), (500, 500)),
+            ]:
+            options = {'crop': crop, 'orientation': orientation}
+            engine = PILEngine()
+            image = engine.draft(engine.get_image(im), geometry, options)
+            self.assertEqual(engine.get_image_size(image), size)
+
+    def testPlannedStages(self):
+        gradient = Image.new('L', (256, 1))
+        gradient.putdata(range(256))
+        image = Image.merge('RGB', [
+            gradient.resize((1200, 400)),
+            gradient.resize((400, 1200)).transpose(Image.ROTATE_90),
+            gradient.resize((1200, 400)).transpose(Image.FLIP_LEFT_RIGHT),
+            ])
+        engine = PILEngine()
+        for colorspace in ('RGB', 'GRAY'):
+            options = {'crop': '20% 50%', 'colorspace': colorspace,
+                       'upscale': True}
+            ref = engine.crop(
+                engine.scale(engine.colorspace(image, None, options),
+                             (60, 60), options),
+                (60, 60), options)
+            im = engine.create(image, (60, 60), options)
+            self.assertEqual(im.size, (60, 60))
+            self.assertEqual(im.mode, ref.mode)
+            for x, y in [(0, 0), (30, 30), (59, 59), (10, 50)]:
+                for a, b in zip(im.convert('RGB').getpixel((x, y)),
+                                ref.convert('RGB').getpixel((x, y))):
+                    self.assertTrue(abs(a - b) < 5)
+
+    def testConvertRun(self):
+        engine = ConvertEngine()
+        self.assertEqual(engine._run(['cat'], 'image data'), 'image data')
+        self.assertRaises(ThumbnailError, engine._run, ['false'])
+        settings.THUMBNAIL_CONVERT_TIMEOUT = 0.1
+        settings.THUMBNAIL_CONVERT_MAX_PROCS = 1
+        try:
+            self.assertRaises(ThumbnailError, engine._run, ['sleep', '5'])
+            convert_engine.procs.acquire(1)
+            try:
+                self.assertRaises(ThumbnailError, engine._run, ['true'])
+            finally:
+                convert_engine.procs.release()
+            self.assertEqual(engine._run(['true']), '')
+        finally:
+            settings.THUMBNAIL_CONVERT_TIMEOUT = 60
+            settings.THUMBNAIL_CONVERT_MAX_PROCS = None
+        settings.THUMBNAIL_CONVERT_LIMITS = {'threads': 1, 'memory': '64MiB'}
+        try:
+            self.assertEqual(engine._get_command('gm convert'), [
+                'gm', 'convert', '-limit', 'memory', '64MiB', '-limit',
+                'threads', 1])
+        finally:
+            settings.THUMBNAIL_CONVERT_LIMITS = {}
+
+    def testConvertWriteMany(self):
+        engine = ConvertEngine()
+        runs = []
+        def run(args, data=None):
+            runs.append(args)
+            return ''
+        engine._run = run
+        class Thumbnail(object):
+            def write(self, raw_data):
+                pass
+        def get_images():
+            images = []
+            for draft, size in [((400, 300), (300, 300)),
+                                ((1000, 75), (1000, 10))]:
+                image = {'source': 'source.jpg', 'data': None,
+                         'options': SortedDict(), 'size': size,
+                         'draft': draft}
+                engine._scale(image, *size)
+                images.append((image, Thumbnail()))
+            return images
+        options = {'format': 'JPEG', 'quality': 85}
+        command = settings.THUMBNAIL_CONVERT
+        try:
+            settings.THUMBNAIL_CONVERT = 'convert'
+            engine.write_many(get_images(), options)
+            self.assertEqual(len(runs), 1)
+            args = runs[0]
+            self.assertEqual(args[:7], [
+                'convert', '-define', 'jpeg:size=1000x300', 'source.jpg',
+                '-write', 'mpr:source', '+delete'])
+            self.assertEqual(args.count('mpr:source'), 3)
+            self.assertEqual(args[7:10], ['mpr:source', '-scale', '300x300!'])
+            i = args.index('mpr:source', 8)
+            self.assertEqual(args[i:i + 3],
+                             ['mpr:source', '-scale', '1000x10!'])
+            self.assertEqual(args[-1], 'null:')
+            runs[:] = []
+            settings.THUMBNAIL_CONVERT = 'gm convert'
+            engine.write_many(get_images(), options)
+            self.assertEqual(len(runs), 2)
+            self.assertEqual(runs[0][:5],
+                             ['gm', 'convert', '-size', '400x300',
+                              'source.jpg'])
+            self.assertEqual(runs[1][:5],
+                             ['gm', 'convert', '-size', '1000x75',
+                              'source.jpg'])
+            for args in runs:
+                self.assertFalse('mpr:source' in args)
+        finally:
+            settings.THUMBNAIL_CONVERT = command
+
+    def testEncoderOptions(self):
+        engine = PILEngine()
+        small = Image.new('RGB', (80, 60))
+        large = Image.new('RGB', (600, 400))
+        self.assertEqual(engine.get_encoder_options(small, {}),
+                         {'progressive': False, 'optimize': True})
+        self.assertEqual(engine.get_encoder_options(large, {}),
+                         {'progressive': True, 'optimize': True})
+        options = {'progressive': True, 'optimize': False}
+        self.assertEqual(engine.get_encoder_options(small, options), options)
+        settings.THUMBNAIL_OPTIMIZE_MIN_PIXELS = 100 * 100
+        try:
+            self.assertEqual(engine.get_encoder_options(small, {}),
+                             {'progressive': False, 'optimize': False})
+        finally:
+            settings.THUMBNAIL_OPTIMIZE_MIN_PIXELS = 0
+        # convert settings persist across outputs so each output resets them
+        engine = ConvertEngine()
+        options = {'format': 'JPEG', 'quality': 85}
+        for progressive, optimize, args in [
+                (True, False, ['-interlace', 'line', '-quality', '85',
+                               '-define', 'jpeg:optimize-coding=false']),
+                (False, True, ['-interlace', 'none', '-quality', '85',
+                               '+define', 'jpeg:optimize-coding']),
+            ]:
+            image = {'options': SortedDict(), 'size': (80, 60)}
+            options.update(progressive=progressive, optimize=optimize)
+            self.assertEqual(engine._get_output_args(image, options), args)
+
+    def testRawFile(self):
+        engine = PILEngine()
+        image = Image.frombytes('RGB', (300, 200), os.urandom(300 * 200 * 3))
+        for progressive, optimize in [(True, True), (False, False)]:
+            content = engine._get_raw_file(image, 'JPEG', 95, progressive,
+                                           optimize)
+            data = content.read()
+            content.close()
+            self.assertEqual(len(data), content.size)
+            self.assertEqual(Image.open(StringIO(data)).size, (300, 200))
+
+    def testResampleStrategy(self):
+        gradient = Image.new('L', (256, 1))
+        gradient.putdata(range(256))
+        image = gradient.resize((1200, 900))
+        engine = PILEngine()
+        ref = engine._scale(image, 100, 75)
+        try:
+            for strategy in ('reduce', 'fast'):
+                settings.THUMBNAIL_RESAMPLE_STRATEGY = strategy
+                im = engine._scale(image, 100, 75)
+                self.assertEqual(im.size, (100, 75))
+                for x in xrange(0, 100, 10):
+                    self.assertTrue(abs(im.getpixel((x, 37)) - ref.getpixel((x, 37))) < 5)
+        finally:
+            settings.THUMBNAIL_RESAMPLE_STRATEGY = 'antialias'
+
     def testIsPortrait(self):
         im = ImageFile(Item.objects.get(image='500x500.jpg').image)
         th = self.backend.get_thumbnail(im, '50x200', crop='center')
@@ -219,6 +715,18 @@ class SimpleTestCase(SimpleTestCaseBase):
         self.kvstore.clear()
         keys_test(0, 0, 0)
 
+    def test_thumbnail_keys(self):
+        key = 'thumbnail_keys_test'
+        self.kvstore._delete(key, identity='thumbnails')
+        for thumbnail_key in ('a', 'b', 'c', 'a'):
+            self.kvstore._add_thumbnail_key(key, thumbnail_key)
+        self.assertEqual(sorted(self.kvstore._get(key, identity='thumbnails')),
+                         ['a', 'b', 'c'])
+        self.kvstore._remove_thumbnail_keys(key, ['a', 'c', 'd'])
+        self.assertEqual(self.kvstore._get(key, identity='thumbnails'), ['b'])
+        self.kvstore._remove_thumbnail_keys(key, ['b'])
+        self.assertEqual(self.kvstore._get(key, identity='thumbnails'), None)
+
     def test_storage_serialize(self):
         im = ImageFile(Item.objects.get(image='500x500.jpg').image)
         self.assertEqual(im.serialize_storage(), 'thumbnail_tests.storage.TestStorage')
@@ -317,6 +825,24 @@ class TemplateTestCaseA(SimpleTestCaseBase):
         }).strip()
         self.assertEqual(val0, val1)
 
+    def test_prefetch(self):
+        items = list(Item.objects.all())
+        expected = []
+        for item in items[:-1]:
+            im = self.backend.get_thumbnail(item.image, '30x30', crop='center')
+            expected.append('<img src="%s" width="%s" height="%s">' % (
+                im.url, im.x, im.y))
+        context = {}
+        prefetch_thumbnails(context, [item.image for item in items], '30x30',
+                            crop='center')
+        self.assertEqual(len(context[PREFETCH_VAR]), len(items) - 1)
+        kvlog.start_log()
+        val = render_to_string('thumbnail21.html', {
+            'items': items[:-1],
+        }).strip()
+        self.assertEqual(kvlog.stop_log(), ['get_many'])
+        self.assertEqual(val, ''.join(expected))
+
     def test_progressive(self):
         im = Item.objects.get(image='500x500.jpg').image
         th = self.backend.get_thumbnail(im, '100x100', progressive=True)
@@ -405,6 +931,143 @@ class TemplateTestCaseClient(unittest.TestCase):
             setattr(settings, k, v)
 
 
+class NumpyEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        if numpy_engine is None:
+            self.skipTest('NumPy is not installed')
+        self.engine = numpy_engine.Engine()
+
+    def testResample(self):
+        gradient = Image.new('L', (256, 1))
+        gradient.putdata(range(256))
+        image = Image.merge('RGB', [
+            gradient.resize((1200, 900)),
+            gradient.resize((900, 1200)).transpose(Image.ROTATE_90),
+            gradient.resize((1200, 900)).transpose(Image.FLIP_LEFT_RIGHT),
+            ])
+        pil = PILEngine()
+        try:
+            for strategy in ('antialias', 'reduce', 'fast'):
+                settings.THUMBNAIL_RESAMPLE_STRATEGY = strategy
+                for size in [(100, 75), (90, 120), (1500, 1000)]:
+                    ref = pil._scale(image, *size)
+                    im = self.engine._scale(
+                        numpy_engine.ArrayImage(source=image), *size)
+                    self.assertEqual(im.size, size)
+                    im = im.to_pil()
+                    for x in xrange(0, size[0], size[0] / 10):
+                        for y in (0, size[1] / 2, size[1] - 1):
+                            for a, b in zip(im.getpixel((x, y)),
+                                            ref.getpixel((x, y))):
+                                self.assertTrue(abs(a - b) < 5)
+        finally:
+            settings.THUMBNAIL_RESAMPLE_STRATEGY = 'antialias'
+
+    def testOrientation(self):
+        image = Image.new('RGB', (3, 2))
+        image.putdata([(i * 40, 0, 0) for i in xrange(6)])
+        pil = PILEngine()
+        for orientation in xrange(1, 9):
+            im = self.engine._orientation(numpy_engine.ArrayImage(
+                source=image, orientation=orientation)).to_pil()
+            method = pil_engine.ORIENTATION_TRANSPOSES.get(orientation)
+            ref = image if method is None else image.transpose(method)
+            self.assertEqual(im.size, ref.size)
+            self.assertEqual(list(im.getdata()), list(ref.getdata()))
+
+    def testCMYK(self):
+        image = Image.new('CMYK', (4, 1))
+        image.putdata([(0, 0, 0, 0), (255, 0, 0, 0), (30, 60, 90, 20),
+                       (200, 200, 200, 200)])
+        for colorspace, mode in [('RGB', 'RGB'), ('GRAY', 'L')]:
+            im = self.engine._colorspace(numpy_engine.ArrayImage(
+                source=image), colorspace).to_pil()
+            ref = image.convert('RGB').convert(mode)
+            self.assertEqual(im.mode, mode)
+            for a, b in zip(im.getdata(), ref.getdata()):
+                if mode == 'L':
+                    a, b = (a,), (b,)
+                for x, y in zip(a, b):
+                    self.assertTrue(abs(x - y) <= 1)
+
+
+class RedisKVStoreTestCase(SimpleTestCaseBase):
+    def setUp(self):
+        super(RedisKVStoreTestCase, self).setUp()
+        if (redis_kvstore is None or
+            not isinstance(self.kvstore, redis_kvstore.KVStore)):
+            self.tearDown()
+            self.skipTest('Not using the redis kvstore')
+        self.kvstore.clear()
+        self.source = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.thumbnails = [
+            ImageFile(Item.objects.get(image=name).image)
+            for name in ('100x100.jpg', '200x100.jpg')
+            ]
+
+    def tearDown(self):
+        if redis_kvstore is not None and \
+           isinstance(self.kvstore, redis_kvstore.KVStore):
+            self.kvstore.clear()
+        super(RedisKVStoreTestCase, self).tearDown()
+
+    def test_set_many(self):
+        self.kvstore.set(self.source)
+        log = []
+        connection = self.kvstore.connection
+        def pipeline(*args, **kwargs):
+            log.append('pipeline')
+            return type(connection).pipeline(connection, *args, **kwargs)
+        def sadd(*args, **kwargs):
+            log.append('sadd')
+            return type(connection).sadd(connection, *args, **kwargs)
+        connection.pipeline = pipeline
+        connection.sadd = sadd
+        try:
+            self.kvstore.set_many(self.thumbnails, self.source,
+                                  {'quality': 50})
+        finally:
+            del connection.pipeline
+            del connection.sadd
+        self.assertEqual(log, ['pipeline'])
+        for thumbnail in self.thumbnails:
+            self.assertEqual(self.kvstore.get(thumbnail).size,
+                             thumbnail.size)
+            self.assertEqual(
+                self.kvstore._get(thumbnail.key, identity='options'),
+                {'quality': 50})
+        self.assertEqual(
+            sorted(self.kvstore._get(self.source.key, identity='thumbnails')),
+            sorted(thumbnail.key for thumbnail in self.thumbnails))
+
+    def test_set_many_missing_source(self):
+        self.assertRaises(ThumbnailError, self.kvstore.set_many,
+                          self.thumbnails, self.source)
+
+    def test_convert_thumbnail_keys(self):
+        self.kvstore.set(self.source)
+        raw_key = add_prefix(self.source.key, identity='thumbnails')
+        first, second = [thumbnail.key for thumbnail in self.thumbnails]
+        # Thumbnail keys as stored by earlier versions
+        self.kvstore._set_raw(raw_key, serialize([first]))
+        self.kvstore.set_many(self.thumbnails[1:], self.source)
+        self.assertEqual(sorted(self.kvstore.connection.smembers(raw_key)),
+                         sorted([first, second]))
+        self.kvstore._set_raw(raw_key, serialize([first, second]))
+        self.assertEqual(
+            sorted(self.kvstore._get(self.source.key, identity='thumbnails')),
+            sorted([first, second]))
+        self.assertEqual(sorted(self.kvstore.connection.smembers(raw_key)),
+                         sorted([first, second]))
+
+    def test_connection_pool(self):
+        other = get_module_class(settings.THUMBNAIL_KVSTORE)()
+        self.assertTrue(other.connection.connection_pool is
+                        self.kvstore.connection.connection_pool)
+        self.assertTrue(redis_kvstore.get_connection_pool() is
+                        self.kvstore.connection.connection_pool)
+
+
 class CropTestCase(unittest.TestCase):
     def setUp(self):
         self.backend = get_module_class(settings.THUMBNAIL_BACKEND)()
@@ -536,6 +1199,43 @@ class ModelTestCase(SimpleTestCaseBase):
         self.assertEqual(1, len(list(self.kvstore._find_keys(identity='thumbnails'))))
 
 
+class ManagementTestCase(SimpleTestCaseBase):
+    def test_warm(self):
+        self.kvstore.clear()
+        resume = pjoin(settings.MEDIA_ROOT, 'warmed.txt')
+        call_command('thumbnail', 'warm', 'thumbnail_tests.Item.image',
+                     specs=['20x20', '30x30 crop=center', '40 crop=center'],
+                     resume=resume, chunk_size=2)
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.assertEqual(3, len(self.kvstore._get(im.key, identity='thumbnails')))
+        th = self.backend.get_thumbnail(im, '30x30', crop='center')
+        self.assertEqual(self.kvstore.get(th).x, 30)
+        # items from other tests whose files are gone fail and are not recorded
+        with open(resume) as fp:
+            self.assertEqual(
+                sorted(fp.read().split()),
+                ['100x100.jpg', '200x100.jpg', '500x500.jpg']
+                )
+        Item.objects.exclude(image__in=['100x100.jpg', '200x100.jpg', '500x500.jpg']).delete()
+        slog.start_log()
+        call_command('thumbnail', 'warm', 'thumbnail_tests.Item.image',
+                     specs=['50x50'], resume=resume)
+        self.assertEqual(slog.stop_log(), [])
+
+    def test_warm_lazy(self):
+        self.kvstore.clear()
+        settings.THUMBNAIL_LAZY = True
+        try:
+            call_command('thumbnail', 'warm', 'thumbnail_tests.Item.image',
+                         specs=['20x20 crop=center'])
+            im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+            th = self.backend.get_thumbnail(im, '20x20', crop='center')
+            self.assertTrue(th.exists())
+        finally:
+            settings.THUMBNAIL_LAZY = False
+        self.assertEqual(self.kvstore.get(th).size, [20, 20])
+
+
 class BackendTest(SimpleTestCaseBase):
     def test_delete(self):
         im1 = Item.objects.get(image='100x100.jpg').image